@@ -0,0 +1,121 @@
+# Generator of synthetic revision histories of a single file, used by run_benchmarks.py
+# Histories are fully determined by their parameters (including the seed) so that runs can be compared
+
+import random
+
+# Lines that appear many times in a typical source file
+COMMON_LINES = ["", "}", "{", "return None", "else:", "pass", "break", "end", "# TODO", "i += 1"]
+
+WORDS = ["value", "index", "result", "count", "name", "data", "item", "self", "node", "user", "total", "buffer",
+         "return", "if", "for", "while", "in", "not", "and", "or", "None", "True", "False", "=", "+", "(", ")", "[",
+         "]", ",", ":", "0", "1", "2"]
+
+
+def __random_line(generator, line_length, duplicates):
+    """ Create a line of code
+
+    :param generator: random number generator
+    :type generator: random.Random
+    :param line_length: average number of characters of a line
+    :type line_length: int
+    :param duplicates: probability that the line is one of the common lines
+    :type duplicates: float
+
+    :return: line without its new line character
+    :rtype: str
+    """
+    if generator.random() < duplicates:
+        return generator.choice(COMMON_LINES)
+    words = []
+    length = 0
+    target = generator.randint(line_length // 2, line_length * 3 // 2)
+    while length < target:
+        words.append(generator.choice(WORDS))
+        length += len(words[-1]) + 1
+    return " " * (4 * generator.randint(0, 3)) + " ".join(words)
+
+
+def __edit_line(generator, line):
+    """ Change a few characters of a line
+
+    :param generator: random number generator
+    :type generator: random.Random
+    :param line: line to change
+    :type line: str
+
+    :return: changed line
+    :rtype: str
+    """
+    characters = list(line)
+    for x in range(0, generator.randint(1, 4)):
+        position = generator.randint(0, len(characters))
+        operation = generator.random()
+        if operation < 0.4 and position < len(characters):
+            characters[position] = generator.choice("abcdefxyz_ ")
+        elif operation < 0.7:
+            characters.insert(position, generator.choice("abcdefxyz_ "))
+        elif position < len(characters):
+            del characters[position]
+    return "".join(characters)
+
+
+def generate_history(seed=0, lines=200, revisions=20, edit_density=0.05, moves=0.0, reformat=0.0, duplicates=0.1,
+                     authors=5, line_length=40, reverts=0.0):
+    """ Generate the revisions of a file
+
+    :param seed: seed of the random number generator
+    :type seed: int
+    :param lines: number of lines of the first revision
+    :type lines: int
+    :param revisions: number of revisions, including the first one
+    :type revisions: int
+    :param edit_density: fraction of the lines changed, inserted or deleted by every revision
+    :type edit_density: float
+    :param moves: fraction of the lines moved to another position (in blocks) by every revision
+    :type moves: float
+    :param reformat: probability that a revision reformats the whole file (indentation and spacing of every line)
+    :type reformat: float
+    :param duplicates: probability that a line is one of a few common lines (e.g. braces, blank lines)
+    :type duplicates: float
+    :param authors: number of authors, every revision is submitted by a random author
+    :type authors: int
+    :param line_length: average number of characters of a line
+    :type line_length: int
+    :param reverts: probability that a revision brings back one of the last five revisions (churn)
+    :type reverts: float
+
+    :return: tuples of (text of the revision, author)
+    :rtype: list
+    """
+    generator = random.Random(seed)
+    code = [__random_line(generator, line_length, duplicates) for x in range(0, lines)]
+    history = []
+    for revision in range(0, revisions):
+        if revision > 0 and reverts > 0 and generator.random() < reverts:  # same histories as before without reverts
+            code = history[generator.randrange(max(0, revision - 5), revision)][0].split("\n")[:-1]
+        elif revision > 0:
+            for x in range(0, max(1, int(len(code) * edit_density))):
+                operation = generator.random()
+                if operation < 0.5 and len(code) > 0:
+                    position = generator.randrange(0, len(code))
+                    code[position] = __edit_line(generator, code[position])
+                elif operation < 0.75 or len(code) == 0:
+                    code.insert(generator.randint(0, len(code)), __random_line(generator, line_length, duplicates))
+                else:
+                    del code[generator.randrange(0, len(code))]
+            moved = int(len(code) * moves)
+            while moved > 0 and len(code) > 1:
+                size = min(moved, generator.randint(1, 10), len(code) - 1)
+                start = generator.randrange(0, len(code) - size + 1)
+                block = code[start:start + size]
+                del code[start:start + size]
+                position = generator.randint(0, len(code))
+                code[position:position] = block
+                moved -= size
+            if generator.random() < reformat:
+                indentation = generator.choice([2, 4, 8])
+                code = [" " * (indentation * ((len(line) - len(line.lstrip(" "))) // 4)) +
+                        line.strip().replace(" = ", "=").replace(", ", ",") for line in code]
+        author = "author%d" % generator.randrange(0, authors)
+        history.append(("\n".join(code) + "\n", author.encode("utf-8")))
+    return history
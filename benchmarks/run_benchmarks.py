@@ -0,0 +1,222 @@
+# Benchmarks of git_persistence on synthetic histories (see history_generator.py)
+# Usage (from the root of the repository):
+#   env PYTHONPATH=. python3 benchmarks/run_benchmarks.py --output results.json
+#   env PYTHONPATH=. python3 benchmarks/run_benchmarks.py --quick --compare results.json
+# Results are written as JSON so that runs (e.g. before and after a change) can be compared with --compare
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from git_persistence import GitPersistence, Metrics
+from history_generator import generate_history
+
+# Scenarios of the scaling curves: parameters of generate_history() on top of the number of lines
+SCENARIOS = {
+    "edits": dict(edit_density=0.05),
+    "dense_edits": dict(edit_density=0.3),
+    "moves": dict(edit_density=0.02, moves=0.1),
+    "reformat": dict(edit_density=0.02, reformat=0.3),
+    "duplicates": dict(edit_density=0.05, duplicates=0.6),
+    "many_authors": dict(edit_density=0.05, authors=200),
+    "churn": dict(edit_density=0.2, reverts=0.5),
+}
+
+SIZES = [100, 200, 400, 800, 1600]
+QUICK_SIZES = [100, 400]
+
+# Files of the git fixture used by the end to end benchmark: name -> (lines, revisions)
+FIXTURE_FILES = {"small.py": (50, 10), "medium.c": (300, 15), "large.txt": (1000, 8)}
+
+
+def benchmark_history(history, backend="python", repeat=3):
+    """ Time GitPersistence on a history
+
+    :param history: tuples of (text of the revision, author)
+    :type history: list
+    :param backend: attribution storage of GitPersistence
+    :type backend: str
+    :param repeat: number of times calculate_ownership() and html_print() are timed (the best time is kept)
+    :type repeat: int
+
+    :return: timings in seconds and counters of the run
+    :rtype: dict
+    """
+    metrics = Metrics()
+    start = time.perf_counter()
+    tracking = GitPersistence(history[0][0], history[0][1], backend=backend, metrics=metrics)
+    update_times = []
+    for text, author in history[1:]:
+        update_start = time.perf_counter()
+        tracking.update(text, author)
+        update_times.append(time.perf_counter() - update_start)
+    total = time.perf_counter() - start
+    ownership = []
+    html = []
+    for x in range(0, repeat):
+        ownership_start = time.perf_counter()
+        tracking.calculate_ownership()
+        ownership.append(time.perf_counter() - ownership_start)
+        html_start = time.perf_counter()
+        tracking.html_print()
+        html.append(time.perf_counter() - html_start)
+    return {"total_seconds": total,
+            "update_mean_seconds": sum(update_times) / max(1, len(update_times)),
+            "update_max_seconds": max(update_times) if len(update_times) > 0 else 0.0,
+            "calculate_ownership_seconds": min(ownership),
+            "html_print_seconds": min(html),
+            "characters": len(history[-1][0]),
+            "counters": metrics.counters,
+            "match_cache": tracking.match_cache.stats()}
+
+
+def scaling_curves(sizes, revisions, backend, seed):
+    """ Run every scenario for every file size
+
+    :param sizes: numbers of lines of the first revision
+    :type sizes: list
+    :param revisions: number of revisions of every history
+    :type revisions: int
+    :param backend: attribution storage of GitPersistence
+    :type backend: str
+    :param seed: seed of the histories
+    :type seed: int
+
+    :return: one result per scenario and size
+    :rtype: list
+    """
+    results = []
+    for scenario in sorted(SCENARIOS):
+        for lines in sizes:
+            history = generate_history(seed=seed, lines=lines, revisions=revisions, **SCENARIOS[scenario])
+            result = benchmark_history(history, backend)
+            result.update({"name": "%s/%d" % (scenario, lines), "scenario": scenario, "lines": lines})
+            results.append(result)
+            print("%-24s %10.4fs total %10.6fs per update" %
+                  (result["name"], result["total_seconds"], result["update_mean_seconds"]), file=sys.stderr)
+    return results
+
+
+def create_fixture(path, seed):
+    """ Create a git repository with the histories of FIXTURE_FILES, every revision is a commit of its author
+
+    :param path: directory of the repository
+    :type path: str
+    :param seed: seed of the histories
+    :type seed: int
+
+    :return: None
+    :rtype: None
+    """
+    subprocess.run(["git", "init", "-q", path], check=True)
+    histories = dict((name, generate_history(seed=seed + x, lines=lines, revisions=revisions, moves=0.02))
+                     for x, (name, (lines, revisions)) in enumerate(sorted(FIXTURE_FILES.items())))
+    timestamp = 1500000000
+    for revision in range(0, max(revisions for lines, revisions in FIXTURE_FILES.values())):
+        for name in sorted(histories):
+            if revision >= len(histories[name]):
+                continue
+            text, author = histories[name][revision]
+            with open(os.path.join(path, name), "w") as file_descriptor:
+                file_descriptor.write(text)
+            timestamp += 3600
+            environment = dict(os.environ,
+                               GIT_AUTHOR_NAME=author.decode("utf-8"), GIT_AUTHOR_EMAIL="%s@example.com" % author,
+                               GIT_COMMITTER_NAME=author.decode("utf-8"), GIT_COMMITTER_EMAIL="%s@example.com" % author,
+                               GIT_AUTHOR_DATE="%d +0000" % timestamp, GIT_COMMITTER_DATE="%d +0000" % timestamp)
+            subprocess.run(["git", "add", name], cwd=path, check=True)
+            subprocess.run(["git", "commit", "-q", "-m", "%s revision %d" % (name, revision)], cwd=path,
+                           env=environment, check=True)
+
+
+def end_to_end(seed):
+    """ Time examples/run_git_persistence.py on a git fixture created in a temporary directory
+
+    :param seed: seed of the histories of the fixture
+    :type seed: int
+
+    :return: timing in seconds and exit code of the script
+    :rtype: dict
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    directory = tempfile.mkdtemp(prefix="git_persistence_benchmark")
+    try:
+        create_fixture(os.path.join(directory, "repository"), seed)
+        work = os.path.join(directory, "work")
+        shutil.copytree(os.path.join(root, "examples"), work)
+        environment = dict(os.environ, PYTHONPATH=root)
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "run_git_persistence.py", os.path.join(directory, "repository")],
+                                 cwd=work, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+        print("%-24s %10.4fs" % ("end_to_end", seconds), file=sys.stderr)
+        return {"name": "end_to_end", "total_seconds": seconds, "exit_code": process.returncode}
+    finally:
+        shutil.rmtree(directory)
+
+
+def compare(results, previous):
+    """ Print the change of the total time of every benchmark against a previous run
+
+    :param results: results of this run
+    :type results: dict
+    :param previous: results of a previous run
+    :type previous: dict
+
+    :return: None
+    :rtype: None
+    """
+    before = dict((result["name"], result["total_seconds"]) for result in previous["results"])
+    for result in results["results"]:
+        if before.get(result["name"], 0) > 0:
+            print("%-24s %10.4fs -> %10.4fs  x%.2f" % (result["name"], before[result["name"]], result["total_seconds"],
+                                                      before[result["name"]] / max(result["total_seconds"], 1e-9)))
+
+
+def main():
+    """ Run the benchmarks and write their results
+
+    :return: None
+    :rtype: None
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks of git_persistence on synthetic histories")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--quick", action="store_true", help="fewer sizes and revisions")
+    parser.add_argument("--backend", default="python", help="attribution storage (python or numpy)")
+    parser.add_argument("--revisions", type=int, default=None, help="revisions of every history")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic histories")
+    parser.add_argument("--no-end-to-end", action="store_true", help="skip the end to end run of the example script")
+    arguments = parser.parse_args()
+
+    revisions = arguments.revisions or (10 if arguments.quick else 30)
+    with contextlib.redirect_stdout(io.StringIO()):  # keep the output of the benchmarked code out of the results
+        results = scaling_curves(QUICK_SIZES if arguments.quick else SIZES, revisions, arguments.backend,
+                                 arguments.seed)
+    if not arguments.no_end_to_end:
+        results.append(end_to_end(arguments.seed))
+    output = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "backend": arguments.backend,
+              "revisions": revisions,
+              "seed": arguments.seed,
+              "results": results}
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file_descriptor:
+            json.dump(output, file_descriptor, indent=1)
+    else:
+        print(json.dumps(output, indent=1))
+    if arguments.compare is not None:
+        with open(arguments.compare) as file_descriptor:
+            compare(output, json.load(file_descriptor))
+
+
+if __name__ == "__main__":
+    main()
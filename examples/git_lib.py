@@ -0,0 +1,244 @@
+# Auxiliary file containing functions for reading data out of a git repository
+
+import os
+import subprocess
+from collections import OrderedDict
+
+# Format of the commit information returned by git log
+LOG_FORMAT = "--pretty=format:@%H%n%an%n%ae%n%at%n%cn%n%ce%n%ct@"
+
+# Object id git reports for the content of a path that does not exist (e.g. a deleted file)
+NULL_OBJECT_ID = "0" * 40
+
+
+class BlobReader:
+    """ Reads blobs by object id through a long-lived 'git cat-file --batch' process
+    Requests are pipelined: all object ids that are not cached are written to the process at once and the contents are
+    read back in the same order. Recently read blobs are kept in a small LRU cache bounded by bytes, so that blobs
+    shared across renames or reverts are only read once. Blobs larger than max_cached_blob are never cached, so that a
+    huge file does not stay in the memory of a worker while it processes other files.
+    """
+
+    # Maximum number of requests written before reading the answers back, this keeps the requests well under the size
+    # of a pipe buffer so that writing never blocks while git waits for its output to be read
+    batch_size = 256
+
+    def __init__(self, git_path, cache_bytes=8 * 1024 * 1024, max_cached_blob=512 * 1024):
+        """ Initializes the reader, the git process is started on first use
+
+        :param git_path: working directory path of git repo
+        :type git_path: str
+        :param cache_bytes: total size in bytes of the blobs kept in the LRU cache
+        :type cache_bytes: int
+        :param max_cached_blob: size in bytes of the largest blob that is cached
+        :type max_cached_blob: int
+
+        :return: None
+        :rtype: None
+        """
+        self.git_path = git_path
+        self.cache_bytes = cache_bytes
+        self.max_cached_blob = max_cached_blob
+        self.cache = OrderedDict()
+        self.cached_bytes = 0  # total size of the blobs in the cache
+        self.process = None
+        self.pid = os.getpid()  # process that owns the reader, a forked process has to start its own
+
+    def __start(self):
+        """ Start the 'git cat-file --batch' process
+
+        :return: None
+        :rtype: None
+        """
+        self.process = subprocess.Popen(["git", "cat-file", "--batch"],
+                                        cwd=self.git_path,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+
+    def __cache(self, object_id, content):
+        """ Add a blob to the LRU cache, evicting the least recently used ones until it fits (blobs larger than
+        max_cached_blob are not added)
+
+        :param object_id: object id of the blob
+        :type object_id: str
+        :param content: content of the blob
+        :type content: bytes
+
+        :return: None
+        :rtype: None
+        """
+        if len(content) > min(self.max_cached_blob, self.cache_bytes) or object_id in self.cache:
+            return
+        self.cache[object_id] = content
+        self.cached_bytes += len(content)
+        while self.cached_bytes > self.cache_bytes:
+            self.cached_bytes -= len(self.cache.popitem(last=False)[1])
+
+    def read(self, object_id):
+        """ Read a single blob
+
+        :param object_id: object id of the blob (or any object name git cat-file accepts)
+        :type object_id: str
+
+        :return: content of the blob, empty if the object does not exist
+        :rtype: bytes
+        """
+        return self.read_many([object_id])[0]
+
+    def read_many(self, object_ids):
+        """ Read several blobs with pipelined requests
+
+        :param object_ids: object ids of the blobs
+        :type object_ids: list
+
+        :return: contents of the blobs in the same order, empty if an object does not exist
+        :rtype: list
+        """
+        contents = dict()
+        pending = []
+        for object_id in object_ids:
+            if object_id == NULL_OBJECT_ID:
+                contents[object_id] = b""
+            elif object_id in self.cache:
+                self.cache.move_to_end(object_id)
+                contents[object_id] = self.cache[object_id]
+            elif object_id not in contents:
+                contents[object_id] = None
+                pending.append(object_id)
+        if len(pending) > 0 and self.process is None:
+            self.__start()
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            self.process.stdin.write(("\n".join(batch) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+            for object_id in batch:
+                header = self.process.stdout.readline().split()
+                if len(header) < 3 or header[-1] == b"missing":
+                    contents[object_id] = b""
+                    continue
+                contents[object_id] = self.process.stdout.read(int(header[2]))
+                self.process.stdout.read(1)  # trailing new line after the content
+                self.__cache(object_id, contents[object_id])
+        return [contents[object_id] for object_id in object_ids]
+
+    def iter_blobs(self, object_ids, prefetch=16):
+        """ Iterate through blobs, reading them ahead in pipelined batches
+
+        :param object_ids: object ids of the blobs
+        :type object_ids: list
+        :param prefetch: number of blobs requested at once
+        :type prefetch: int
+
+        :return: contents of the blobs in the same order
+        :rtype: generator
+        """
+        for start in range(0, len(object_ids), prefetch):
+            for content in self.read_many(object_ids[start:start + prefetch]):
+                yield content
+
+    def close(self):
+        """ Stop the git process
+
+        :return: None
+        :rtype: None
+        """
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+
+
+def blob_sizes(git_path, object_ids):
+    """ Obtain the size of several blobs at once (git cat-file --batch-check)
+
+    :param git_path: working directory path of git repo
+    :type git_path: str
+    :param object_ids: object ids of the blobs
+    :type object_ids: list
+
+    :return: object id -> size in bytes, 0 if the object does not exist
+    :rtype: dict
+    """
+    process = subprocess.Popen(["git", "cat-file", "--batch-check"],
+                               cwd=git_path,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    out, err = process.communicate(("\n".join(object_ids) + "\n").encode("utf-8"))
+    sizes = dict()
+    for line in out.decode("utf-8").splitlines():
+        fields = line.split(" ")  # "<object id> <type> <size>" or "<object id> missing"
+        sizes[fields[0]] = int(fields[2]) if len(fields) == 3 else 0
+    return sizes
+
+
+def __tokens(stream, chunk_size=65536):
+    """ Split a binary stream on NUL characters (output of git commands with -z)
+
+    :param stream: binary file-like object
+    :type stream: io.BufferedReader
+    :param chunk_size: number of bytes read at once
+    :type chunk_size: int
+
+    :return: decoded tokens
+    :rtype: generator
+    """
+    rest = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if len(chunk) == 0:
+            break
+        tokens = (rest + chunk).split(b"\0")
+        rest = tokens.pop()
+        for token in tokens:
+            yield token.decode("utf-8", "replace")
+    if len(rest) > 0:
+        yield rest.decode("utf-8", "replace")
+
+
+def walk_history(git_path):
+    """ Walk the whole history of a repository once (git log --raw -M) and build the chain of revisions of every path,
+    following renames. This replaces running git log --follow for every file. The chains of deleted paths are returned
+    separately, e.g. to credit the code of a file split into new ones to its authors.
+
+    :param git_path: working directory path of git repo
+    :type git_path: str
+
+    :return: path -> revisions in chronological order, each revision is a tuple of the commit info in LOG_FORMAT
+     (hash, author name, author email, author time, committer name, committer email, committer time), the file name
+     at that revision and the blob id, followed by the (path, revisions) of every chain ended by a deletion
+    :rtype: tuple (dict, list)
+    """
+    process = subprocess.Popen(["git", "log", "--raw", "-M", "--no-abbrev", "--reverse", "-z", LOG_FORMAT],
+                               cwd=git_path,
+                               stdout=subprocess.PIPE)
+    chains = dict()
+    deleted = []
+    commit = None
+    entry = None  # raw entry of the commit waiting for its paths: [status, blob, paths...]
+    for token in __tokens(process.stdout):
+        if entry is not None:  # token is a path of the current raw entry
+            entry.append(token)
+            # Renames and copies have a source and a destination path, the rest a single path
+            if len(entry) == 3 + (entry[0][0] in "RC"):
+                status, blob, paths = entry[0], entry[1], entry[2:]
+                revision = commit + (paths[-1], blob)
+                if status[0] == "R":
+                    chains[paths[1]] = chains.pop(paths[0], []) + [revision]
+                elif status[0] == "D":
+                    if paths[0] in chains:  # history restarts if the path is ever added again
+                        deleted.append((paths[0], chains.pop(paths[0])))
+                elif status[0] != "C":
+                    chains.setdefault(paths[-1], []).append(revision)
+                entry = None
+            continue
+        if token.startswith("@"):  # commit information, may be followed by the first raw entry
+            fields = token[1:].split("\n", 7)
+            fields[6] = fields[6][:-1]  # closing @ after the commit timestamp
+            commit = tuple(fields[:7])
+            token = fields[7] if len(fields) > 7 else ""
+        if token.startswith(":"):  # ":<old mode> <new mode> <old blob> <new blob> <status>"
+            fields = token[1:].split(" ")
+            entry = [fields[4], fields[3]]
+    process.wait()
+    return chains, deleted
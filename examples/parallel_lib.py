@@ -1,16 +1,20 @@
 # Auxiliary file containing functions for parallelization
 
 import multiprocessing
+from multiprocessing.connection import wait
+import threading
 import time
 import math
-from psutil import virtual_memory
+import traceback
+from collections import deque
+from psutil import Process, virtual_memory
 
 # Global variables within module's scope
 __start_time_for_x = 0
 __x_marker = 0
 
 
-def __output(log, indicator="TOP"):
+def _output(log, indicator="TOP"):
     """ Helper function to store in a file the logged output of multiple processes
 
     :param log: text to log
@@ -26,19 +30,6 @@ def __output(log, indicator="TOP"):
     f.close()
 
 
-def __check_avail_mem():
-    """ Check that there is at least 20% available memory
-
-    :return: whether memory is less than 80%
-    :rtype: bool
-    """
-    if virtual_memory().percent > 80:
-        __output("Holding pattern...")
-        return False
-    else:
-        return True
-
-
 def mark_time(spacer=False):
     """ Marks the time for event tracking and optimization purposes
 
@@ -66,8 +57,253 @@ def mark_time(spacer=False):
             __x_marker += 1
 
 
-def parallel_process(processes, process_list, input_function):
-    """ Marks the time for event tracking and optimization purposes
+class _MemorySampler(threading.Thread):
+    """ Samples the resident memory of the current process in the background to find how much it grew while a task
+    runs. The growth is measured from the memory of the process when the task started, so that memory a worker keeps
+    across tasks (caches, allocator arenas) is not charged to every task that follows a large one.
+    """
+
+    def __init__(self, interval=0.05):
+        """ Initializes the sampler
+
+        :param interval: seconds between two samples
+        :type interval: float
+
+        :return: None
+        :rtype: None
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.process = Process()
+        self.start_rss = self.process.memory_info().rss
+        self.peak = self.start_rss
+        self.stopped = threading.Event()
+
+    def run(self):
+        """ Sample until stopped
+
+        :return: None
+        :rtype: None
+        """
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def stop(self):
+        """ Stop sampling
+
+        :return: peak resident memory in bytes above the memory of the process when the task started
+        :rtype: int
+        """
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+        return self.peak - self.start_rss
+
+
+def _worker(input_function, connection, initializer=None, initargs=()):
+    """ Loop of a worker process: receive tasks until a None task is received and send back the results along with the
+    growth of the resident memory of the process while the task ran (see _MemorySampler)
+
+    :param input_function: function executing a task, receives the task as its first argument
+    :type input_function: def
+    :param connection: worker end of the pipe to the scheduler
+    :type connection: multiprocessing.connection.Connection
+    :param initializer: function called when the worker starts
+    :type initializer: def
+    :param initargs: arguments of the initializer
+    :type initargs: tuple
+
+    :return: None
+    :rtype: None
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        sampler = _MemorySampler()
+        sampler.start()
+        try:
+            result = input_function(task)
+            connection.send((True, result, sampler.stop()))
+        except Exception:
+            connection.send((False, traceback.format_exc(), sampler.stop()))
+    connection.close()
+
+
+class Scheduler:
+    """ Runs tasks on a persistent pool of worker processes
+    Pending tasks are kept in a queue by the scheduler and handed to a worker as soon as it is idle, so at most one
+    task per worker is in flight and the scheduler decides what runs next. Results are returned to the parent process
+    as they complete. The scheduler blocks on the workers' pipes and process sentinels instead of polling, and a worker
+    that dies (e.g. killed by the OOM killer) is replaced.
+    Tasks are admitted only while the predicted memory of all running tasks fits the memory budget, and memory is held
+    back for the first task waiting for it so that it is not overtaken by smaller tasks until the end. Tasks predicted
+    to need more than their share of the budget (budget / processes) run in a separate lane with its own, lower,
+    concurrency so that a few giant files cannot take over every worker.
+    """
+
+    def __init__(self, processes, input_function, memory_budget=None, large_task_processes=1, initializer=None,
+                 initargs=()):
+        """ Initializes the scheduler, worker processes are started by run()
+
+        :param processes: number of processes that can run in parallel
+        :type processes: int
+        :param input_function: function to execute the parallel process. Functions receives as a first argument element
+         from the task list and its return value is sent back to the parent process
+        :type input_function: def
+        :param memory_budget: bytes of memory the running tasks can use together (defaults to 80% of the memory
+         available when the scheduler is created)
+        :type memory_budget: int
+        :param large_task_processes: number of tasks predicted to exceed their share of the budget that can run at once
+        :type large_task_processes: int
+        :param initializer: function called by every worker process when it starts (as in multiprocessing.Pool), e.g.
+         to receive a queue that can only be passed at process creation
+        :type initializer: def
+        :param initargs: arguments of the initializer
+        :type initargs: tuple
+
+        :return: None
+        :rtype: None
+        """
+        self.processes = processes
+        self.input_function = input_function
+        self.memory_budget = memory_budget if memory_budget is not None else int(virtual_memory().available * 0.8)
+        self.large_task_processes = large_task_processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.workers = []  # [process, connection, number of the task it runs or None, predicted memory of the task]
+
+    def __start_worker(self):
+        """ Start a worker process
+
+        :return: None
+        :rtype: None
+        """
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_worker, args=(self.input_function, worker_connection,
+                                                                        self.initializer, self.initargs))
+        process.start()
+        worker_connection.close()
+        self.workers.append([process, connection, None, 0])
+        _output([worker[0] for worker in self.workers])
+
+    def __is_large(self, predicted):
+        """ Whether a task belongs to the lane of large tasks
+
+        :param predicted: predicted memory of the task in bytes
+        :type predicted: int
+
+        :return: whether the task exceeds its share of the memory budget
+        :rtype: bool
+        """
+        return predicted > self.memory_budget / self.processes
+
+    def __admit(self, pending, memory):
+        """ Pick the next pending task that fits in the memory budget, in order of the pending queue. The memory of the
+        first task that does not fit yet is reserved, so that smaller tasks behind it only fill the memory left beside
+        it and it starts as soon as enough running tasks complete.
+
+        :param pending: numbers of the pending tasks
+        :type pending: collections.deque
+        :param memory: predicted memory of each task in bytes
+        :type memory: list
+
+        :return: number of the task to run next or None if no task can be started
+        :rtype: int
+        """
+        running = [worker[3] for worker in self.workers if worker[2] is not None]
+        running_large = len([predicted for predicted in running if self.__is_large(predicted)])
+        reserved = None  # memory of the first task waiting for memory
+        for number in pending:
+            if self.__is_large(memory[number]) and running_large >= self.large_task_processes:
+                continue
+            if len(running) == 0 or sum(running) + (reserved or 0) + memory[number] <= self.memory_budget:
+                return number  # at least one task runs
+            if reserved is None:
+                reserved = memory[number]
+        return None
+
+    def run(self, tasks, costs=None, memory=None):
+        """ Execute all tasks and return the results as they complete
+
+        :param tasks: tasks to be processed by the parallel function
+        :type tasks: list
+        :param costs: estimated cost of each task, the most expensive tasks are dispatched first so that a long task
+         does not start last and hold the whole run (tasks are dispatched in order if None)
+        :type costs: list
+        :param memory: predicted memory of each task in bytes (tasks are not limited by memory if None)
+        :type memory: list
+
+        :return: tuples of (task, result, peak growth of the resident memory of the worker in bytes), result is None
+         if the task failed and the peak is None if the worker died
+        :rtype: generator
+        """
+        for x in range(0, self.processes):
+            self.__start_worker()
+        if costs is None:
+            pending = deque(range(0, len(tasks)))
+        else:
+            pending = deque(sorted(range(0, len(tasks)), key=lambda number: -costs[number]))
+        if memory is None:
+            memory = [0] * len(tasks)
+        in_flight = 0
+        try:
+            while len(pending) > 0 or in_flight > 0:
+                for worker in self.workers:
+                    if worker[2] is None and len(pending) > 0:
+                        number = self.__admit(pending, memory)
+                        if number is None:
+                            _output("Holding pattern...")
+                            break
+                        pending.remove(number)
+                        worker[2] = number
+                        worker[3] = memory[number]
+                        worker[1].send(tasks[number])
+                        in_flight += 1
+                busy = [worker for worker in self.workers if worker[2] is not None]
+                ready = wait([worker[1] for worker in busy] + [worker[0].sentinel for worker in busy])
+                for worker in busy:
+                    died = False
+                    if worker[1] in ready:
+                        try:
+                            success, result, peak = worker[1].recv()
+                        except EOFError:  # the pipe was closed by a worker that died
+                            died = True
+                    elif worker[0].sentinel in ready:
+                        died = True
+                    else:
+                        continue
+                    number = worker[2]
+                    worker[2] = None
+                    in_flight -= 1
+                    if died:
+                        _output("Worker died while processing task %s" % str(tasks[number]), worker[0].pid)
+                        result = None
+                        peak = None
+                        worker[0].join()
+                        worker[1].close()
+                        self.workers.remove(worker)
+                        self.__start_worker()
+                    elif not success:
+                        _output(result, worker[0].pid)
+                        result = None
+                    _output("Peak memory: %s predicted: %s" % (str(peak), str(memory[number])), worker[0].pid)
+                    yield tasks[number], result, peak
+        finally:
+            for worker in self.workers:
+                if worker[0].is_alive():
+                    worker[1].send(None)
+            for worker in self.workers:
+                worker[0].join()
+                worker[1].close()
+            self.workers = []
+            _output("done")
+
+
+def parallel_process(processes, process_list, input_function, costs=None):
+    """ Process a list in parallel with a Scheduler
 
      :param processes: number of processes that can run in parallel
      :type processes: int
@@ -76,37 +312,13 @@ def parallel_process(processes, process_list, input_function):
      :param input_function: function to execute the parallel process. Functions receives as a first argument element
      from the process list
      :type input_function: def
+     :param costs: estimated cost of each element of the process list, most expensive elements are processed first
+     :type costs: list
 
-     :return: None
-     :rtype: None
+     :return: results of input_function in order of completion
+     :rtype: list
      """
-    a = 0
-    all_records = process_list
-    all_active = []
-    while a < len(all_records):
-        time.sleep(0.5)
-        if __check_avail_mem():
-            # Check all active scripts if they are still active
-            for p in all_active:
-                if not p.is_alive():  # Existing connection false, replace it with a new one
-                    p.join()
-                    all_active.remove(p)
-                    p_new = multiprocessing.Process(target=input_function, args=([all_records[a], ]))
-                    all_active.append(p_new)
-                    __output(all_active)
-                    all_active[len(all_active) - 1].start()
-                    a += 1
-                    mem = virtual_memory()
-                    __output("Mem used: " + str(mem.percent))
-            if len(all_active) < processes:  # do the same
-                p_new = multiprocessing.Process(target=input_function, args=([all_records[a], ]))
-                all_active.append(p_new)
-                __output(all_active)
-                all_active[len(all_active) - 1].start()
-                a += 1
-                mem = virtual_memory()
-                __output("Mem used: " + str(mem.percent))
-    __output("done")
+    return [result for task, result, peak in Scheduler(processes, input_function).run(process_list, costs)]
 
 
 def test(x):
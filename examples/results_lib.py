@@ -0,0 +1,259 @@
+# Auxiliary file containing the storage of results produced by parallel processes
+
+import multiprocessing
+import queue
+import sqlite3
+import threading
+
+# Columns of every table of results, TSV exports keep the same order of columns
+TABLES = {
+    "commits": ["commit_hash", "author_name", "author_email", "author_time", "committer_name", "committer_email",
+                "committer_time", "path", "file"],
+    "pa_per_rev": ["commit_hash", "file", "user", "characters", "persistence"],
+    "persistence_scores": ["file", "user", "characters", "persistence"],
+    "times": ["file", "lines", "seconds"],
+    "memory": ["file", "peak"],
+    "git_fame_per_rev": ["record", "commit_hash"],
+    "checkpoints": ["file", "revisions"],  # revisions of a file whose rows were committed when a checkpoint was saved
+}
+
+# Indexed columns of every table
+INDEXES = {
+    "commits": ["file", "commit_hash"],
+    "pa_per_rev": ["file", "commit_hash", "user"],
+    "persistence_scores": ["file", "user"],
+    "times": ["file"],
+    "memory": ["file"],
+    "git_fame_per_rev": ["commit_hash"],
+    "checkpoints": ["file"],
+}
+
+
+class ResultBatch:
+    """ Collects the rows produced by a worker process and sends them to the ResultSink in batches
+    """
+
+    def __init__(self, channel, batch_size=1000):
+        """ Initializes an empty batch
+
+        :param channel: queue of the ResultSink
+        :type channel: multiprocessing.Queue
+        :param batch_size: number of rows collected before they are sent
+        :type batch_size: int
+
+        :return: None
+        :rtype: None
+        """
+        self.channel = channel
+        self.batch_size = batch_size
+        self.rows = dict()  # table -> rows waiting to be sent
+        self.size = 0
+
+    def add(self, table, row):
+        """ Add a row, the batch is sent once it is full
+
+        :param table: name of the table (see TABLES)
+        :type table: str
+        :param row: values of the columns of the table
+        :type row: tuple
+
+        :return: None
+        :rtype: None
+        """
+        self.rows.setdefault(table, []).append(row)
+        self.size += 1
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Send the rows collected so far
+
+        :return: None
+        :rtype: None
+        """
+        if self.size > 0:
+            self.channel.put(self.rows)
+            self.rows = dict()
+            self.size = 0
+
+
+class ResultSink:
+    """ Single writer of the results of all processes into an SQLite database
+    Worker processes send batches of rows through a queue (see ResultBatch) and a thread of the parent process inserts
+    them, so that no two processes write to the same file and rows are inserted many at a time in one transaction.
+    Tables can be exported as tab separated files compatible with the ones the processes used to write directly.
+    """
+
+    def __init__(self, path):
+        """ Opens (or creates) the database, the writer is started by start()
+
+        :param path: path of the SQLite database
+        :type path: str
+
+        :return: None
+        :rtype: None
+        """
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        for table, columns in TABLES.items():
+            self.connection.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (table, ", ".join(columns)))
+            for column in INDEXES[table]:
+                self.connection.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)" % (table, column, table, column))
+        self.connection.commit()
+        self.channel = multiprocessing.Queue()
+        self.thread = None
+
+    def __insert(self, rows):
+        """ Insert a batch of rows
+
+        :param rows: table -> rows
+        :type rows: dict
+
+        :return: None
+        :rtype: None
+        """
+        for table, table_rows in rows.items():
+            self.connection.executemany("INSERT INTO %s VALUES (%s)" % (table, ", ".join(["?"] * len(TABLES[table]))),
+                                        table_rows)
+
+    def __write(self):
+        """ Loop of the writer thread: insert batches until a None batch is received, batches that are already waiting
+        are inserted in the same transaction
+
+        :return: None
+        :rtype: None
+        """
+        running = True
+        while running:
+            batches = [self.channel.get()]
+            try:
+                while batches[-1] is not None:
+                    batches.append(self.channel.get_nowait())
+            except queue.Empty:
+                pass
+            for rows in batches:
+                if rows is None:
+                    running = False
+                else:
+                    self.__insert(rows)
+            self.connection.commit()
+
+    def start(self):
+        """ Start the writer thread
+
+        :return: None
+        :rtype: None
+        """
+        self.thread = threading.Thread(target=self.__write, daemon=True)
+        self.thread.start()
+
+    def put(self, table, rows):
+        """ Send rows from the parent process
+
+        :param table: name of the table (see TABLES)
+        :type table: str
+        :param rows: values of the columns of the table
+        :type rows: list
+
+        :return: None
+        :rtype: None
+        """
+        self.channel.put({table: rows})
+
+    def insert(self, table, rows):
+        """ Insert rows directly from the parent process, only while the writer is stopped
+
+        :param table: name of the table (see TABLES)
+        :type table: str
+        :param rows: values of the columns of the table
+        :type rows: list
+
+        :return: None
+        :rtype: None
+        """
+        self.__insert({table: rows})
+        self.connection.commit()
+
+    def delete(self, table, column, values):
+        """ Delete the rows of a table with a column in a set of values, only while the writer is stopped
+
+        :param table: name of the table (see TABLES)
+        :type table: str
+        :param column: column of the table
+        :type column: str
+        :param values: values of the rows to delete
+        :type values: collections.Iterable
+
+        :return: None
+        :rtype: None
+        """
+        self.connection.executemany("DELETE FROM %s WHERE %s = ?" % (table, column), [(value,) for value in values])
+        self.connection.commit()
+
+    def delete_rows(self, table, columns, rows):
+        """ Delete the rows of a table matching given values of several columns, only while the writer is stopped
+
+        :param table: name of the table (see TABLES)
+        :type table: str
+        :param columns: columns of the table
+        :type columns: list
+        :param rows: values of the columns of every row to delete
+        :type rows: collections.Iterable
+
+        :return: None
+        :rtype: None
+        """
+        self.connection.executemany("DELETE FROM %s WHERE %s" % (table, " AND ".join(["%s = ?" % column for column
+                                                                                      in columns])), rows)
+        self.connection.commit()
+
+    def select(self, table, columns=None):
+        """ Read the rows of a table in order of insertion
+
+        :param table: name of the table (see TABLES)
+        :type table: str
+        :param columns: columns to read (all columns if None)
+        :type columns: list
+
+        :return: rows
+        :rtype: list
+        """
+        columns = TABLES[table] if columns is None else columns
+        return self.connection.execute("SELECT %s FROM %s ORDER BY rowid" % (", ".join(columns), table)).fetchall()
+
+    def export(self, table, filename, separator="\t"):
+        """ Write a table as a tab separated file
+
+        :param table: name of the table (see TABLES)
+        :type table: str
+        :param filename: path of the tab separated file
+        :type filename: str
+        :param separator: separator of the columns
+        :type separator: str
+
+        :return: None
+        :rtype: None
+        """
+        with open(filename, "w") as file_descriptor:
+            for row in self.select(table):
+                file_descriptor.write(separator.join([str(value) for value in row]) + "\n")
+
+    def stop(self):
+        """ Wait for the writer thread to insert all rows sent. Processes sending rows must have exited (or flushed
+        their queue) before, otherwise their last rows may arrive after the writer stopped.
+
+        :return: None
+        :rtype: None
+        """
+        if self.thread is not None:
+            self.channel.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        """ Stop the writer thread and close the database
+
+        :return: None
+        :rtype: None
+        """
+        self.stop()
+        self.connection.close()
@@ -5,9 +5,19 @@
 
 import os
 import csv
-import re
+from multiprocessing.managers import SyncManager
+import hashlib
+import json
+import shutil
+import time
 from git_persistence import GitPersistence
+from git_persistence.metrics import Metrics, NULL_METRICS
+from git_persistence.match_cache import MatchCache
+from git_persistence.comparison_pool import ComparisonPool
+from git_persistence.line_index import LineIndex
 import parallel_lib
+import git_lib
+import results_lib
 import sys
 import datetime
 import subprocess
@@ -18,6 +28,64 @@ GIT_PATH = sys.argv[1]
 # Excluding files that are binary
 FILES_TO_EXCLUDE = ["png", "bmp", "dll", "jpg", "jpeg", "exe", "ttf", "ico", "icns", "svg", "ogg"]
 
+# Bytes of memory that the worker processes can use together (None defaults to 80% of the available memory)
+MEMORY_BUDGET = None
+
+# Memory estimate of a file: a worker's own footprint plus the growth recorded by a previous run (memory.tsv), or else a
+# multiple of the size of the file's latest revision (text, lines and attribution of the old and new revisions)
+WORKER_MEMORY = 32 * 1024 * 1024
+MEMORY_PER_BYTE = 20
+
+# Reader of blobs shared by all files processed by a worker process (see blob_reader())
+__blob_reader = None
+
+# Cache of line comparisons shared by all files processed by a worker process (see match_cache())
+__match_cache = None
+
+# Processes of every worker process comparing the changed lines of huge revisions (see comparison_pool()). A single
+# huge file otherwise runs on one core while the others are idle at the end of a run. 0 compares in the worker itself.
+POOL_PROCESSES = 0
+__comparison_pool = None
+
+# Results are stored in an SQLite database by a single writer in the parent process and exported as TSV files at the
+# end of the run. Worker processes send their rows in batches (see init_worker()).
+RESULTS_DB = "results.db"
+RESULT_TABLES = ["commits", "pa_per_rev", "persistence_scores", "times", "memory"]
+__result_batch = None
+
+# Commits whose git fame baseline was computed or is being computed, shared by all worker processes (see claim_commit())
+__fame_registry = None
+
+# Seconds a revision can spend comparing changed lines (None is unlimited). A pathological revision (e.g. generated or
+# minified code, mass reformatting) then attributes the lines it could not compare to its author instead of holding the
+# worker for hours. GitPersistence also falls back to cheaper strategies for large changes on its own.
+TIME_BUDGET = None
+
+# Directory where an HTML ownership view of every processed file is written (None disables it)
+HTML_DIR = None
+
+# Directory where the state of every file is saved while it is processed, so that a run that crashed can be resumed with
+# --resume (python run_git_persistence.py <git path> --resume) instead of replaying each file's history from the start
+CHECKPOINT_DIR = "checkpoints"
+CHECKPOINT_SECONDS = 60  # minimum number of seconds between two checkpoints of the same file
+RESUME = "--resume" in sys.argv[2:]
+
+# With --incremental the checkpoints of the previous run are kept and only the commits made since are processed, the
+# results of the files that changed are updated in place
+INCREMENTAL = "--incremental" in sys.argv[2:]
+
+# With --metrics counters and timers of every phase are collected per file and per revision, and written to
+# metrics.json (with the breakdowns) and metrics.prom (totals in the Prometheus text format)
+METRICS = "--metrics" in sys.argv[2:]
+
+# With --moved-code the lines of every revision of every file are first added to a repository-wide index (served to the
+# worker processes by the manager of the parent process), then lines of the first revision of a file that were already
+# in another file are credited to the author of the revision where they first appeared instead of whoever moved them.
+# The index is saved to LINE_INDEX_PATH so that --incremental finds the lines of files that are not processed again.
+MOVED_CODE = "--moved-code" in sys.argv[2:]
+LINE_INDEX_PATH = "line_index.snapshot"
+__line_index = None
+
 
 def execute_and_return(command_list, git_path):
     """ Helper function that runs a command and stores output as a file
@@ -30,50 +98,193 @@ def execute_and_return(command_list, git_path):
     :return: output and error (if any)
     :rtype: tuple
     """
-    current_dir = os.getcwd()
-    os.chdir(git_path)
     process = subprocess.Popen(command_list,
+                               cwd=git_path,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
     out, err = process.communicate()
-    os.chdir(current_dir)
     return out, err
 
 
-def read_git_commit_log(data):
-    """ Returns commit log from a file containing the exported git log.
-    Note: Highly customized for a specific purpose.
+def blob_reader():
+    """ Returns the blob reader of the current process, a new one is started in every worker process
+
+    :return: long-lived reader of blobs from the git repo
+    :rtype: git_lib.BlobReader
+    """
+    global __blob_reader
+    if __blob_reader is None or __blob_reader.pid != os.getpid():
+        __blob_reader = git_lib.BlobReader(GIT_PATH)
+    return __blob_reader
+
 
-    :param data: specific format list of commits returned by git log:
-     --pretty*=format:@%H%n%an%n%ae%n%at%n%cn%n%ce%n%ct@
+def init_worker(channel, fame_registry, line_index=None):
+    """ Initializer of the worker processes, rows are sent to the parent process through the channel
+
+    :param channel: queue of the result sink of the parent process
+    :type channel: multiprocessing.Queue
+    :param fame_registry: commit hash -> process that claimed the commit, shared by all processes
+    :type fame_registry: multiprocessing.managers.DictProxy
+    :param line_index: index of the lines of all files, shared by all processes (None without --moved-code)
+    :type line_index: git_persistence.line_index.LineIndex
+
+    :return: None
+    :rtype: None
+    """
+    global __result_batch
+    global __fame_registry
+    global __line_index
+    __result_batch = results_lib.ResultBatch(channel)
+    __fame_registry = fame_registry
+    __line_index = line_index
+
+
+def claim_commit(commit):
+    """ Claim the computation of the git fame baseline of a commit. The claim is a single setdefault on the shared
+    registry, so every commit is claimed by exactly one process.
+
+    :param commit: commit hash
+    :type commit: str
+
+    :return: whether the current process claimed the commit and has to compute its baseline
+    :rtype: bool
+    """
+    return __fame_registry.setdefault(commit, os.getpid()) == os.getpid()
+
+
+def open_line_index(path=None):
+    """ Creates the index of lines in the manager process, from the snapshot of a previous run if there is one
+
+    :param path: path of the snapshot (an empty index is created if None or missing)
+    :type path: str
+
+    :return: index of lines
+    :rtype: git_persistence.line_index.LineIndex
+    """
+    if path is not None and os.path.isfile(path):
+        with open(path, "rb") as file_descriptor:
+            return LineIndex.load(file_descriptor)
+    return LineIndex()
+
+
+class ResultsManager(SyncManager):
+    """ Manager of the objects shared by the worker processes (git fame registry and index of lines)
+    """
+    pass
+
+
+ResultsManager.register("LineIndex", open_line_index)
+
+
+def moved_code_origins(data, username, commit, filename):
+    """ Find the lines of the first revision of a file that were already in another file, in blocks of consecutive
+    lines from the same file (see LineIndex.lookup_blocks())
+
+    :param data: text of the first revision
     :type data: str
+    :param username: user that submitted the revision
+    :type username: bytes
+    :param commit: commit info of the revision (see process_git_file())
+    :type commit: tuple
+    :param filename: file of the revision
+    :type filename: str
 
-    :return: list of formatted entries
+    :return: spans of the text owned by other users, tuples of (start, length, user) (see GitPersistence())
     :rtype: list
     """
-    matches = re.findall('@(.*?)\n(.*?)\n(.*?)\n(.*?)\n(.*?)\n(.*?)\n(.*?)@\n(.*?)(?:$|\n)', data, re.DOTALL)
-    return matches
+    lines = data.splitlines(True)
+    found = __line_index.lookup_blocks([LineIndex.hash_line(line) for line in lines], int(commit[3]), filename)
+    origins = []
+    start = 0
+    for line, occurrence in zip(lines, found):
+        if occurrence is not None and occurrence[2] != username:
+            origins.append((start, len(line), occurrence[2]))
+        start += len(line)
+    return origins
+
+
+def index_git_file(task):
+    """ Add the lines of every revision of a file to the index of lines, with the commit where they first appeared
+
+    :param task: filename and its revisions in chronological order (see process_git_file())
+    :type task: tuple
+
+    :return: None
+    :rtype: None
+    """
+    filename, revisions = task
+    if filename.split(".")[len(filename.split(".")) - 1] in FILES_TO_EXCLUDE:
+        return
+    entries = dict()  # line hash -> first occurrence in the file
+    for commit, out in zip(revisions, blob_reader().iter_blobs([commit[8] for commit in revisions])):
+        for line in decode_blob(out).splitlines():
+            key = LineIndex.hash_line(line)
+            if key is not None and key not in entries:
+                entries[key] = (key, int(commit[3]), filename, commit[0], commit[1].encode("utf-8"))
+    __line_index.add(list(entries.values()))
+
+
+def decode_blob(out):
+    """ Text of a blob
+
+    :param out: content of the blob
+    :type out: bytes
+
+    :return: text
+    :rtype: str
+    """
+    try:
+        return out.decode("utf-8")
+    except UnicodeEncodeError:  # Try alternative encoding just in case otherwise it is a binary file probably
+        return out.decode("utf-16")
+
+
+def result_batch():
+    """ Returns the batch of rows of the current worker process
+
+    :return: batch of rows waiting to be sent to the parent process
+    :rtype: results_lib.ResultBatch
+    """
+    return __result_batch
 
 
-def store_revisions(commit_list, file_referenced, filename):
-    """ Append commit log info to a tab separated file
+def match_cache():
+    """ Returns the cache of line comparisons of the current process, created on first use by every worker process
+
+    :return: cache shared by the files processed by the process
+    :rtype: git_persistence.match_cache.MatchCache
+    """
+    global __match_cache
+    if __match_cache is None:
+        __match_cache = MatchCache(100000)
+    return __match_cache
+
+
+def comparison_pool():
+    """ Returns the pool comparing the changed lines of huge revisions for the current process, started on first use
+
+    :return: pool shared by the files processed by the process (None if POOL_PROCESSES is 0)
+    :rtype: git_persistence.comparison_pool.ComparisonPool
+    """
+    global __comparison_pool
+    if __comparison_pool is None and POOL_PROCESSES > 0:
+        __comparison_pool = ComparisonPool(POOL_PROCESSES)
+    return __comparison_pool
+
+
+def store_revisions(commit_list, file_referenced):
+    """ Store commit log info
 
     :param commit_list: list containing git log info
     :type commit_list: list
     :param file_referenced: filename that git log points to
     :type file_referenced: str
-    :param filename: filename that git log is appened in
-    :type filename: str
 
     :return: None
     :rtype: None
     """
-    f = open(filename, 'a')
     for commit in commit_list:
-        text = "\t".join(commit)
-        text += "\t" + file_referenced
-        f.write(text + "\n")
-    f.close()
+        result_batch().add("commits", tuple(commit[:8]) + (file_referenced,))
 
 
 def reset_files():
@@ -92,128 +303,416 @@ def reset_files():
         os.remove("pa_per_rev.tsv")
     if os.path.isfile("git_fame_per_rev.tsv"):
         os.remove("git_fame_per_rev.tsv")
+    if os.path.isfile("memory.tsv"):
+        os.remove("memory.tsv")
+    if os.path.isfile(RESULTS_DB):
+        os.remove(RESULTS_DB)
+    if os.path.isdir(CHECKPOINT_DIR):
+        shutil.rmtree(CHECKPOINT_DIR)
+    if os.path.isfile(LINE_INDEX_PATH):
+        os.remove(LINE_INDEX_PATH)
 
 
-def pre_process():
-    """ Obtain all files that are part of the repo and expected to be processed
+def checkpoint_path(filename):
+    """ Path of the checkpoint of a file
+
+    :param filename: file name in the git repo
+    :type filename: str
+
+    :return: path of the checkpoint
+    :rtype: str
+    """
+    return os.path.join(CHECKPOINT_DIR, hashlib.sha1(filename.encode("utf-8")).hexdigest() + ".snapshot")
+
+
+def save_checkpoint(filename, tracking, commit, done, data_ag):
+    """ Save the state of a file after one of its revisions. The checkpoint starts with a line holding the commit, the
+    number of revisions processed and the aggregated number of lines, followed by the GitPersistence snapshot.
+
+    :param filename: file name in the git repo
+    :type filename: str
+    :param tracking: state of the file
+    :type tracking: GitPersistence
+    :param commit: hash of the last commit processed
+    :type commit: str
+    :param done: number of revisions processed
+    :type done: int
+    :param data_ag: aggregated number of lines of the revisions processed
+    :type data_ag: int
+
+    :return: None
+    :rtype: None
+    """
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    path = checkpoint_path(filename)
+    with open(path + ".tmp", "wb") as file_descriptor:
+        file_descriptor.write(("%s\t%s\t%s\n" % (commit, str(done), str(data_ag))).encode("utf-8"))
+        tracking.save(file_descriptor)
+    os.replace(path + ".tmp", path)  # a crash while saving leaves the previous checkpoint intact
+
+
+def load_checkpoint(filename, revisions, restore=True, metrics=None):
+    """ Load the saved state of a file if it matches its revisions
+
+    :param filename: file name in the git repo
+    :type filename: str
+    :param revisions: revisions of the file in chronological order
+    :type revisions: list
+    :param restore: restore the state of the file, otherwise only the number of revisions processed is read
+    :type restore: bool
+    :param metrics: metrics of the restored state
+    :type metrics: git_persistence.metrics.Metrics
+
+    :return: state of the file (None if there is no usable checkpoint or if not restored), number of revisions
+     processed and aggregated number of lines
+    :rtype: tuple
+    """
+    path = checkpoint_path(filename)
+    if not os.path.isfile(path):
+        return None, 0, 0
+    with open(path, "rb") as file_descriptor:
+        commit, done, data_ag = file_descriptor.readline().decode("utf-8").rstrip("\n").split("\t")
+        done = int(done)
+        if done == 0 or done > len(revisions) or revisions[done - 1][0] != commit:  # history was rewritten
+            return None, 0, 0
+        if not restore:
+            return None, done, int(data_ag)
+        tracking = GitPersistence.load(file_descriptor, metrics=metrics, time_budget=TIME_BUDGET,
+                                       match_cache=match_cache(), pool=comparison_pool())
+        return tracking, done, int(data_ag)
+
+
+def stored_revisions(sink):
+    """ Number of revisions of every file whose results were committed to the database, the rows of a checkpoint are
+    committed along with its number of revisions (see process_git_file())
+
+    :param sink: result storage
+    :type sink: results_lib.ResultSink
+
+    :return: file -> number of revisions
+    :rtype: dict
+    """
+    stored = dict()
+    for filename, done in sink.select("checkpoints"):
+        stored[filename] = max(done, stored.get(filename, 0))
+    return stored
+
+
+def checkpoint_revisions(filename, revisions, stored):
+    """ Number of revisions of a file processed by a previous run. A checkpoint saved before all the results of its
+    revisions reached the database (e.g. the run crashed while they were sent) cannot be continued and is removed, the
+    file is then processed from its first revision.
+
+    :param filename: file name in the git repo
+    :type filename: str
+    :param revisions: revisions of the file in chronological order
+    :type revisions: list
+    :param stored: number of revisions of every file whose results were committed (see stored_revisions())
+    :type stored: dict
+
+    :return: number of revisions processed
+    :rtype: int
+    """
+    tracking, done, data_ag = load_checkpoint(filename, revisions, False)
+    if done > stored.get(filename, 0):
+        os.remove(checkpoint_path(filename))
+        return 0
+    return done
+
+
+def forget_revisions(sink, filename, revisions, done):
+    """ Remove the per revision results of a file stored for revisions that are going to be processed again (e.g. after
+    the last checkpoint of a run that crashed), so that they are not stored twice
+
+    :param sink: result storage, with its writer stopped
+    :type sink: results_lib.ResultSink
+    :param filename: file name in the git repo
+    :type filename: str
+    :param revisions: revisions of the file in chronological order
+    :type revisions: list
+    :param done: number of revisions whose results are kept
+    :type done: int
 
-    :return: files to be processed by script
+    :return: None
+    :rtype: None
+    """
+    rows = [(filename, commit[0]) for commit in revisions[done:]]
+    sink.delete_rows("pa_per_rev", ["file", "commit_hash"], rows)
+    sink.delete_rows("commits", ["file", "commit_hash"], rows)
+    sink.delete_rows("checkpoints", ["file", "revisions"], [(filename, x) for x in range(done + 1, len(revisions) + 1)])
+
+
+def resume_tasks(tasks):
+    """ Select the files left unfinished by a previous run and remove the results they stored after their last
+    checkpoint, these files are processed again from their checkpoints
+
+    :param tasks: files to be processed and their revisions (see pre_process())
+    :type tasks: list
+
+    :return: files to be processed
     :rtype: list
     """
+    selected = []
+    unfinished = set()
+    sink = results_lib.ResultSink(RESULTS_DB)
+    stored = stored_revisions(sink)
+    for filename, revisions in tasks:
+        done = checkpoint_revisions(filename, revisions, stored)
+        if done < len(revisions):
+            selected.append((filename, revisions))
+            unfinished.add(filename)
+            forget_revisions(sink, filename, revisions, done)
+    # Final results are stored before the final checkpoint, a file may have stored them and still be unfinished
+    for table in ["persistence_scores", "times", "memory"]:
+        sink.delete(table, "file", unfinished)
+    sink.close()
+    return selected
+
+
+def incremental_tasks(tasks):
+    """ Select the files with commits that were not processed by the previous run and remove the results that these
+    files will store again. Files whose history was rewritten (or that are new) are replayed from their first revision.
+
+    :param tasks: files to be processed and their revisions (see pre_process())
+    :type tasks: list
+
+    :return: files to be processed
+    :rtype: list
+    """
+    selected = []
+    replayed = set()
+    processed = dict()  # file -> number of revisions processed by the previous run
+    sink = results_lib.ResultSink(RESULTS_DB)
+    stored = stored_revisions(sink)
+    for filename, revisions in tasks:
+        done = checkpoint_revisions(filename, revisions, stored)
+        if done < len(revisions):
+            selected.append((filename, revisions))
+            processed[filename] = done
+        if done == 0:
+            replayed.add(filename)
+    current = set([filename for filename, revisions in tasks])
+    updated = set([filename for filename, revisions in selected])
+    # Final scores of updated files are replaced, those of files that no longer exist are dropped
+    removed = set([row[0] for row in sink.select("persistence_scores", ["file"]) if row[0] not in current])
+    for table in ["persistence_scores", "memory"]:
+        sink.delete(table, "file", updated | removed)
+    # Times of files that continue from their checkpoints are added to the time of the new commits (see combine_times())
+    sink.delete("times", "file", replayed | removed)
+    # Per revision results are kept and new revisions appended, unless the file is replayed
+    sink.delete("pa_per_rev", "file", replayed)
+    sink.delete("commits", "file", replayed)
+    sink.delete("checkpoints", "file", replayed | removed)
+    # A previous incremental run may have crashed after storing some of the new revisions
+    for filename, revisions in selected:
+        if filename not in replayed:
+            forget_revisions(sink, filename, revisions, processed[filename])
+    sink.close()
+    return selected
+
+
+def combine_times(sink):
+    """ Add up the times stored for the same file by successive runs (an incremental run only times the new commits of
+    a file), so that times.tsv keeps the time of the whole history of every file for estimate_costs()
+
+    :param sink: result storage, with its writer stopped
+    :type sink: results_lib.ResultSink
+
+    :return: None
+    :rtype: None
+    """
+    totals = dict()  # file -> [lines, seconds, number of rows]
+    for filename, lines, seconds in sink.select("times"):
+        if filename in totals:
+            totals[filename] = [lines, totals[filename][1] + float(seconds), totals[filename][2] + 1]
+        else:
+            totals[filename] = [lines, float(seconds), 1]
+    combined = [filename for filename in totals if totals[filename][2] > 1]
+    sink.delete("times", "file", combined)
+    sink.insert("times", [(filename, totals[filename][0], round(totals[filename][1], 4)) for filename in combined])
+
+
+def pre_process():
+    """ Obtain all files that are part of the repo and expected to be processed, with their revisions.
+    History is walked once for the whole repo instead of once per file.
+
+    :return: files to be processed by script, tuples of (file name, revisions in chronological order), followed by the
+     files deleted from the repo in the same form (their lines are only indexed with --moved-code)
+    :rtype: tuple (list, list)
+    """
     out, err = execute_and_return(["git", "ls-tree", "--full-tree", "-r", "HEAD"], GIT_PATH)
     files = []
     csv_reader_descriptor = csv.reader(out.decode("utf-8").splitlines(),
                                        delimiter='\t', quotechar=None, escapechar=None)
     for row in csv_reader_descriptor:
         files.append(row[1])
-    return files
+    chains, deleted = git_lib.walk_history(GIT_PATH)
+    return [(filename, chains[filename]) for filename in files if filename in chains], deleted
+
 
+def estimate_costs(tasks):
+    """ Estimate how long each file will take to process, based on the execution times stored in times.tsv by a previous
+    run. Files without a previous time are estimated from their number of revisions times the size of their latest
+    blob, scaled to seconds with the files that have both.
 
-def process_git_file(filename, store_each_revision=True):
+    :param tasks: files to be processed and their revisions (see pre_process())
+    :type tasks: list
+
+    :return: estimated cost of each task
+    :rtype: list
+    """
+    times = dict()
+    if os.path.isfile("times.tsv"):
+        with open("times.tsv") as file_descriptor:
+            for row in csv.reader(file_descriptor, delimiter='\t', quotechar=None, escapechar=None):
+                times[row[0]] = float(row[2])
+    sizes = git_lib.blob_sizes(GIT_PATH, [revisions[-1][8] for filename, revisions in tasks])
+    units = [len(revisions) * sizes.get(revisions[-1][8], 0) for filename, revisions in tasks]
+    timed = [x for x in range(0, len(tasks)) if tasks[x][0] in times]
+    rate = 1
+    if sum(units[x] for x in timed) > 0:
+        rate = sum(times[tasks[x][0]] for x in timed) / sum(units[x] for x in timed)  # seconds per unit
+    costs = []
+    for x in range(0, len(tasks)):
+        if tasks[x][0].split(".")[len(tasks[x][0].split(".")) - 1] in FILES_TO_EXCLUDE:
+            costs.append(0)
+        else:
+            costs.append(times.get(tasks[x][0], units[x] * rate))
+    return costs
+
+
+def estimate_memory(tasks):
+    """ Estimate the peak memory of a worker processing each file: a worker's own footprint plus the growth stored in
+    memory.tsv by a previous run or a multiple of the size of the file's latest revision
+
+    :param tasks: files to be processed and their revisions (see pre_process())
+    :type tasks: list
+
+    :return: estimated peak memory of each task in bytes
+    :rtype: list
+    """
+    peaks = dict()
+    if os.path.isfile("memory.tsv"):
+        with open("memory.tsv") as file_descriptor:
+            for row in csv.reader(file_descriptor, delimiter='\t', quotechar=None, escapechar=None):
+                peaks[row[0]] = WORKER_MEMORY + int(row[1])
+    sizes = git_lib.blob_sizes(GIT_PATH, [revisions[-1][8] for filename, revisions in tasks])
+    return [peaks.get(filename, WORKER_MEMORY + MEMORY_PER_BYTE * sizes.get(revisions[-1][8], 0))
+            for filename, revisions in tasks]
+
+
+def process_git_file(task, store_each_revision=True):
     """ Calculate git-persistence scores for a file in a git repository. Store results in pre-specified files.
 
-    :param filename: filename to be parsed by git-persistence
-    :type filename: str
+    :param task: filename to be parsed by git-persistence and its revisions in chronological order, each revision is
+     a tuple of commit info (as in --pretty=format:%H%n%an%n%ae%n%at%n%cn%n%ce%n%ct), file name and blob id
+    :type task: tuple
     :param store_each_revision: store git-persistence results for every revision made to the file
     :type store_each_revision: bool
 
-    :return: None
-    :rtype: None
+    :return: counters and timers of the file if metrics are enabled (see METRICS)
+    :rtype: git_persistence.metrics.Metrics
     """
+    filename, revisions = task
     parallel_lib.mark_time()
     print(filename + " " + filename.split(".")[len(filename.split(".")) - 1])
     if filename.split(".")[len(filename.split(".")) - 1] not in FILES_TO_EXCLUDE:
         current_file = filename
         print(current_file)
-        data_ag = 0
-        out, err = execute_and_return(["git", "log", "--name-only",
-                                       "--pretty=format:@%H%n%an%n%ae%n%at%n%cn%n%ce%n%ct@", "--follow",
-                                       current_file], GIT_PATH)
-        # Commit list always returned in chronological order by git
-        commit_list = read_git_commit_log(out.decode("utf-8"))
+        metrics = Metrics(file=current_file) if METRICS else NULL_METRICS
+        tracking, done, data_ag = None, 0, 0
+        if RESUME or INCREMENTAL:
+            # Results stored after the last checkpoint were removed by resume_tasks() or incremental_tasks()
+            tracking, done, data_ag = load_checkpoint(current_file, revisions, metrics=metrics)
+            if done == len(revisions):
+                print("Already processed")
+                return
+        # Commit list in the order returned by git log (latest first), without the revisions already processed
+        commit_list = list(reversed(revisions[done:]))
         # Storing all revisions for records, this is the same commit log appearing on github
-        store_revisions(commit_list, current_file, "commits.tsv")
-        i = 0
-        git_fame_processed_commits = []  # auxiliary list so that we won't obtain git fame for the same commit
-        for commit in reversed(commit_list):
+        store_revisions(commit_list, current_file)
+        i = done
+        checkpoint_time = time.time()
+        blobs = metrics.timed("git_io", blob_reader().iter_blobs([commit[8] for commit in revisions[done:]]))
+        for commit, out in zip(revisions[done:], blobs):
             aggregate_username = commit[1]
             aggregate_username = aggregate_username.encode("utf-8")
-            out, err = execute_and_return(["git", "show", commit[0] + ":" + commit[7]], GIT_PATH)
-            try:
-                data = out.decode("utf-8")
-            except UnicodeEncodeError:  # Try alternative encoding just in case otherwise it is a binary file probably
-                data = out.decode("utf-16")
+            data = decode_blob(out)
             data_ag += len(data.splitlines(False))
 
-            # Start new tracking or update existing (depending on whether we look at the same file)
-            if i == 0:
-                tracking = GitPersistence(data, aggregate_username)
-            else:
-                tracking.update(data, aggregate_username)
-
-            # Store current revision info
-            if store_each_revision:
-                results = tracking.calculate_ownership()
-                f = open("pa_per_rev.tsv", "a")
-                users = [w for w in results[0].keys()]
-                users.extend([w for w in results[1].keys()])
-                for result in set(users):
-                    f.write("%s\t%s\t%s\t%s\t%s\n" %
-                            (commit[0],
-                             current_file,
-                             result.decode("utf-8"),
-                             str(results[0].get(result, 0)),
-                             str(results[1].get(result, 0))))
-                f.close()
-                
-                # To avoid duplicates we will quick grep for the commit number the git fame per rev file
-                # This way if another parallel process already looked at that commit we can skip it
-                # There is still an odd chance that duplicates may be generated so one has to clean those when loading
-                # the csv
-                out, err = execute_and_return(["grep", commit[0], "git_fame_per_rev.tsv"],
-                                              os.getcwd())
-                if len(out.decode("utf-8").splitlines()) == 0:
-                    out, err = execute_and_return(["git", "fame", "--format=csv", "--timeout=-1", "-h", "--before",
-                                                   datetime.datetime.fromtimestamp(int(commit[3])).
-                                                  strftime('%Y-%m-%d')],
-                                                  GIT_PATH)
-                    f = open("git_fame_per_rev.tsv", "a")
-                    git_fame_lines = out.decode("utf-8").splitlines()
-                    a = 0
-                    for line in git_fame_lines:
-                        if a != 0:  # skip first line
-                            f.write("%s,%s\n" % (line.strip(), commit[0]))
-                        a += 1
-                    f.close()
-                    git_fame_processed_commits.append(commit[0])
+            with metrics.revision(commit=commit[0]):
+                # Start new tracking or update existing (depending on whether we look at the same file)
+                if tracking is None:
+                    origins = None
+                    if MOVED_CODE:
+                        with metrics.timer("line_index"):
+                            origins = moved_code_origins(data, aggregate_username, commit, current_file)
+                    tracking = GitPersistence(data, aggregate_username, metrics=metrics, time_budget=TIME_BUDGET,
+                                              match_cache=match_cache(), pool=comparison_pool(), origins=origins)
+                else:
+                    tracking.update(data, aggregate_username)
+
+                # Store current revision info
+                if store_each_revision:
+                    results = tracking.calculate_ownership()
+                    users = [w for w in results[0].keys()]
+                    users.extend([w for w in results[1].keys()])
+                    for result in set(users):
+                        result_batch().add("pa_per_rev", (commit[0],
+                                                          current_file,
+                                                          result.decode("utf-8"),
+                                                          results[0].get(result, 0),
+                                                          results[1].get(result, 0)))
+
+                    # Commits are shared by many files, the git fame baseline of a commit is computed only by the
+                    # process that claims it first
+                    if claim_commit(commit[0]):
+                        with metrics.timer("git_fame"):
+                            out, err = execute_and_return(["git", "fame", "--format=csv", "--timeout=-1", "-h",
+                                                           "--before", datetime.datetime.fromtimestamp(int(commit[3])).
+                                                          strftime('%Y-%m-%d')],
+                                                          GIT_PATH)
+                        git_fame_lines = out.decode("utf-8").splitlines()
+                        a = 0
+                        for line in git_fame_lines:
+                            if a != 0:  # skip first line
+                                result_batch().add("git_fame_per_rev", (line.strip(), commit[0]))
+                            a += 1
 
             i += 1
+            if time.time() - checkpoint_time >= CHECKPOINT_SECONDS:
+                # The rows of the revisions in the checkpoint are committed along with their number, a checkpoint
+                # is only continued by --resume if they were (see checkpoint_revisions())
+                result_batch().add("checkpoints", (current_file, i))
+                result_batch().flush()
+                save_checkpoint(current_file, tracking, commit[0], i, data_ag)
+                checkpoint_time = time.time()
         results = tracking.calculate_ownership()
-        f = open("persistence_scores.tsv", "a")
 
-        # If you need to see changes as a diff file in html activate this
-        # This is an expensive operation so restrict it somehow
-        # with open("diff.html", "w") as text_file:
-        #    text_file.write(tracking.html_print())
+        # If you need to see changes as a diff file in html set HTML_DIR
+        # The view is streamed to the file, one span per run of characters of the same user
+        if HTML_DIR is not None:
+            os.makedirs(HTML_DIR, exist_ok=True)
+            with open(os.path.join(HTML_DIR, current_file.replace("/", "__") + ".html"), "w") as text_file:
+                tracking.write_html(text_file)
 
         # Aggregate users into a list that you can loop
         # this eliminates missing on some that had one value but not another
         users = [w for w in results[0].keys()]
         users.extend([w for w in results[1].keys()])
         for result in set(users):
-            f.write("%s\t%s\t%s\t%s\n" %
-                    (current_file,
-                     result.decode("utf-8"),
-                     str(results[0].get(result, 0)),
-                     str(results[1].get(result, 0))
-                     ))
-        f.close()
+            result_batch().add("persistence_scores", (current_file,
+                                                      result.decode("utf-8"),
+                                                      results[0].get(result, 0),
+                                                      results[1].get(result, 0)))
         execution_time = parallel_lib.mark_time(True)
-        with open("times.tsv", "a") as file_descriptor:
-            file_descriptor.write("%s\t%s\t%s\n" %
-                                  (current_file,
-                                   str(round(data_ag / len(commit_list), 2)),
-                                   str(execution_time)))
+        result_batch().add("times", (current_file, round(data_ag / len(revisions), 2), execution_time))
+        result_batch().add("checkpoints", (current_file, len(revisions)))
+        result_batch().flush()
+        # The final checkpoint marks the file as processed for --resume
+        save_checkpoint(current_file, tracking, revisions[-1][0], len(revisions), data_ag)
+        if METRICS:
+            return metrics
 
 
 # Plenty of commented lines used for different functions and tests
@@ -221,6 +720,57 @@ def process_git_file(filename, store_each_revision=True):
 # As it stands the script below utilizes 1 core (value can be changed)
 # and applies PCC to scientist repository    
 if __name__ == '__main__':
-    FILES = pre_process()
-    reset_files()
-    parallel_lib.parallel_process(8, FILES, process_git_file)
+    ALL_FILES, DELETED_FILES = pre_process()
+    FILES = ALL_FILES
+    if INCREMENTAL:
+        FILES = incremental_tasks(FILES)
+    elif RESUME:
+        FILES = resume_tasks(FILES)
+    # Estimates use times.tsv and memory.tsv of the previous run, before reset_files() removes them
+    COSTS = estimate_costs(FILES)
+    MEMORY = estimate_memory(FILES)
+    if not RESUME and not INCREMENTAL:
+        reset_files()
+    SINK = results_lib.ResultSink(RESULTS_DB)
+    # Commits with a git fame baseline stored by a previous run (resumed or incremental) are not computed again
+    MANAGER = ResultsManager()
+    MANAGER.start()
+    FAME_REGISTRY = MANAGER.dict([(row[0], None) for row in SINK.select("git_fame_per_rev", ["commit_hash"])])
+    LINE_INDEX = None
+    if MOVED_CODE:
+        LINE_INDEX = MANAGER.LineIndex(LINE_INDEX_PATH if RESUME or INCREMENTAL else None)
+    SINK.start()
+    if MOVED_CODE:
+        # Every file is indexed before any file is processed, so that the lines found do not depend on the order in
+        # which files are processed. A resumed run has no index saved if the previous run crashed, the files it
+        # finished are indexed again. Deleted files are indexed too, their code may have been moved to other files.
+        INDEXER = parallel_lib.Scheduler(8, index_git_file, MEMORY_BUDGET, initializer=init_worker,
+                                         initargs=(SINK.channel, FAME_REGISTRY, LINE_INDEX))
+        for TASK, RESULT, PEAK in INDEXER.run((FILES if INCREMENTAL else ALL_FILES) + DELETED_FILES):
+            pass
+    SCHEDULER = parallel_lib.Scheduler(8, process_git_file, MEMORY_BUDGET, initializer=init_worker,
+                                       initargs=(SINK.channel, FAME_REGISTRY, LINE_INDEX))
+    TOTAL_METRICS = Metrics()
+    FILE_METRICS = []
+    for task, result, peak in SCHEDULER.run(FILES, COSTS, MEMORY):
+        if peak is not None:
+            SINK.put("memory", [(task[0], peak)])
+        if result is not None:
+            TOTAL_METRICS.merge(result)
+            FILE_METRICS.append(result.to_dict())
+    SINK.stop()
+    if INCREMENTAL:
+        combine_times(SINK)
+    if LINE_INDEX is not None:
+        with open(LINE_INDEX_PATH, "wb") as file_descriptor:
+            LINE_INDEX._getvalue().save(file_descriptor)
+    MANAGER.shutdown()
+    for TABLE in RESULT_TABLES:
+        SINK.export(TABLE, TABLE + ".tsv")
+    SINK.export("git_fame_per_rev", "git_fame_per_rev.tsv", ",")  # git fame records are comma separated
+    SINK.close()
+    if METRICS:
+        with open("metrics.json", "w") as file_descriptor:
+            json.dump({"total": TOTAL_METRICS.to_dict(), "files": FILE_METRICS}, file_descriptor)
+        with open("metrics.prom", "w") as file_descriptor:
+            file_descriptor.write(TOTAL_METRICS.to_prometheus())
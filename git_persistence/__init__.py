@@ -1,3 +1,7 @@
 from .git_persistence import GitPersistence
+from .metrics import Metrics
+from .match_cache import MatchCache
+from .comparison_pool import ComparisonPool
+from .line_index import LineIndex
 
-__all__ = [GitPersistence]
+__all__ = [GitPersistence, Metrics, MatchCache, ComparisonPool, LineIndex]
@@ -0,0 +1,241 @@
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:  # numpy is optional and only needed for NumpyAttribution
+    numpy = None
+
+
+class AttributionSpans:
+    """Run-length encoded attribution of characters to commit numbers
+    Consecutive characters that came from the same commit are stored as a single (commit_no, run_length) span. Spans
+    are kept in two parallel arrays, one holding the commit number of each run and one holding the cumulative end
+    position of each run, so that any character position can be located with a binary search.
+    The number of characters attributed to each commit is kept up to date as runs are appended.
+    """
+
+    def __init__(self):
+        """ Initializes an empty attribution store
+
+        :return: None
+        :rtype: None
+        """
+        self.commits = array('l')  # commit number of each run
+        self.ends = array('q')  # cumulative end position (exclusive) of each run
+        self.counts = dict()  # commit number -> number of characters, in order of first appearance
+
+    @classmethod
+    def from_runs(cls, commits, lengths):
+        """ Build a store from runs
+
+        :param commits: commit number of each run
+        :type commits: array.array
+        :param lengths: length of each run
+        :type lengths: array.array
+
+        :return: attribution store
+        :rtype: AttributionSpans
+        """
+        spans = cls()
+        for x in range(0, len(commits)):
+            spans.append(commits[x], lengths[x])
+        return spans
+
+    def __len__(self):
+        """ Total number of characters attributed
+
+        :return: number of characters
+        :rtype: int
+        """
+        if len(self.ends) == 0:
+            return 0
+        return self.ends[-1]
+
+    def __iter__(self):
+        """ Iterate through the commit number of every character (expands the runs)
+
+        :return: commit number per character
+        :rtype: generator
+        """
+        for commit, length in self.runs():
+            for x in range(0, length):
+                yield commit
+
+    def runs(self):
+        """ Iterate through all runs of the store
+
+        :return: tuples of (commit number, run length)
+        :rtype: generator
+        """
+        start = 0
+        for x in range(0, len(self.commits)):
+            yield self.commits[x], self.ends[x] - start
+            start = self.ends[x]
+
+    def append(self, commit, length):
+        """ Attribute the next 'length' characters to a commit, coalescing with the last run when possible
+
+        :param commit: the numeric value of the commit
+        :type commit: int
+        :param length: number of characters to attribute
+        :type length: int
+
+        :return: None
+        :rtype: None
+        """
+        if length <= 0:
+            return
+        self.counts[commit] = self.counts.get(commit, 0) + length
+        end = len(self) + length
+        if len(self.commits) > 0 and self.commits[-1] == commit:
+            self.ends[-1] = end
+        else:
+            self.commits.append(commit)
+            self.ends.append(end)
+
+    def extend_from(self, other, start, length):
+        """ Copy the attribution of a character block of another store as spans
+
+        :param other: store to copy from
+        :type other: AttributionSpans
+        :param start: start position of the block in the other store
+        :type start: int
+        :param length: length of the block
+        :type length: int
+
+        :return: None
+        :rtype: None
+        """
+        stop = start + length
+        run = bisect_right(other.ends, start)  # first run that ends after start
+        while start < stop:
+            end = min(other.ends[run], stop)
+            self.append(other.commits[run], end - start)
+            start = end
+            run += 1
+
+
+class NumpyAttribution:
+    """NumPy backed attribution of characters to commit numbers
+    Holds one integer per character in a NumPy array. A new revision is built as a list of pieces (slices of the
+    previous array for matched blocks and filled ranges for new code) that are concatenated once on first access, and
+    character counts per commit are computed with bincount. Produces the same results as AttributionSpans.
+    """
+
+    def __init__(self):
+        """ Initializes an empty attribution store
+
+        :return: None
+        :rtype: None
+        """
+        if numpy is None:
+            raise ImportError("The numpy backend requires numpy to be installed")
+        self.pieces = []  # arrays waiting to be concatenated
+        self.length = 0
+        self.__array = numpy.zeros(0, dtype=numpy.int32)
+
+    @classmethod
+    def from_runs(cls, commits, lengths):
+        """ Build a store from runs
+
+        :param commits: commit number of each run
+        :type commits: array.array
+        :param lengths: length of each run
+        :type lengths: array.array
+
+        :return: attribution store
+        :rtype: NumpyAttribution
+        """
+        store = cls()
+        store.pieces.append(numpy.repeat(numpy.asarray(commits, dtype=numpy.int32),
+                                         numpy.asarray(lengths, dtype=numpy.int64)))
+        store.length = int(sum(lengths))
+        return store
+
+    @property
+    def array(self):
+        """ Commit number of every character, concatenating pending pieces if needed
+
+        :return: commit number per character
+        :rtype: numpy.ndarray
+        """
+        if len(self.pieces) > 0:
+            self.__array = numpy.concatenate([self.__array] + self.pieces)
+            self.pieces = []
+        return self.__array
+
+    @property
+    def counts(self):
+        """ Number of characters attributed to each commit
+
+        :return: commit number -> number of characters
+        :rtype: dict
+        """
+        counts = numpy.bincount(self.array)
+        commits = numpy.flatnonzero(counts)
+        return dict(zip(commits.tolist(), counts[commits].tolist()))
+
+    def __len__(self):
+        """ Total number of characters attributed
+
+        :return: number of characters
+        :rtype: int
+        """
+        return self.length
+
+    def __iter__(self):
+        """ Iterate through the commit number of every character
+
+        :return: commit number per character
+        :rtype: iterator
+        """
+        return iter(self.array.tolist())
+
+    def runs(self):
+        """ Iterate through all runs of consecutive characters that belong to the same commit
+
+        :return: tuples of (commit number, run length)
+        :rtype: generator
+        """
+        code = self.array
+        if len(code) == 0:
+            return
+        starts = numpy.concatenate(([0], numpy.flatnonzero(code[1:] != code[:-1]) + 1))
+        stops = numpy.append(starts[1:], len(code))
+        for commit, start, stop in zip(code[starts].tolist(), starts.tolist(), stops.tolist()):
+            yield commit, stop - start
+
+    def append(self, commit, length):
+        """ Attribute the next 'length' characters to a commit
+
+        :param commit: the numeric value of the commit
+        :type commit: int
+        :param length: number of characters to attribute
+        :type length: int
+
+        :return: None
+        :rtype: None
+        """
+        if length <= 0:
+            return
+        self.pieces.append(numpy.full(length, commit, dtype=numpy.int32))
+        self.length += length
+
+    def extend_from(self, other, start, length):
+        """ Copy the attribution of a character block of another store as a slice
+
+        :param other: store to copy from
+        :type other: NumpyAttribution
+        :param start: start position of the block in the other store
+        :type start: int
+        :param length: length of the block
+        :type length: int
+
+        :return: None
+        :rtype: None
+        """
+        if length <= 0:
+            return
+        self.pieces.append(other.array[start:start + length])
+        self.length += length
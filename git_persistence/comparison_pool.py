@@ -0,0 +1,219 @@
+import difflib
+import multiprocessing
+import os
+import sys
+import time
+from array import array
+from itertools import accumulate
+from multiprocessing import resource_tracker, shared_memory
+
+# Clock of the deadlines given to the processes, it must be shared by all processes: time.perf_counter() is system-wide
+# on Linux and macOS (CLOCK_MONOTONIC), elsewhere it may be relative to each process
+clock = time.perf_counter if sys.platform.startswith(("linux", "darwin")) else time.time
+
+
+def _share_lines(old_texts, new_texts):
+    """ Copy two lists of lines to a new block of shared memory: the number of lines of each list, the end position of
+    every line and the lines encoded as UTF-8
+
+    :param old_texts: lines of the previous revision
+    :type old_texts: list
+    :param new_texts: lines of the new revision
+    :type new_texts: list
+
+    :return: block of shared memory, to be unlinked by the caller
+    :rtype: multiprocessing.shared_memory.SharedMemory
+    """
+    encoded = [text.encode("utf-8", "surrogatepass") for text in old_texts]
+    encoded.extend(text.encode("utf-8", "surrogatepass") for text in new_texts)
+    header = array('q', [len(old_texts), len(new_texts), 0])
+    header.extend(accumulate(map(len, encoded)))
+    header = header.tobytes()
+    payload = b"".join(encoded)
+    memory = shared_memory.SharedMemory(create=True, size=max(1, len(header) + len(payload)))
+    memory.buf[:len(header)] = header
+    memory.buf[len(header):len(header) + len(payload)] = payload
+    return memory
+
+
+def _compare(task):
+    """ Compare a range of old lines with their candidate new lines, in a process of the pool. Pairs are checked in the
+    same order and with the same bounds as the serial comparison of GitPersistence, so that the same pairs are found.
+
+    :param task: (name of the shared memory, first and last old line, candidate range of every old line, group of
+     every old line, group of every new line, min_threshold, max_line_length, deadline on clock() or None, estimated
+     seconds of a comparison per pair of characters)
+    :type task: tuple
+
+    :return: old line and candidate pairs (new line, ratio, matching blocks) of every old line compared, number of
+     comparisons made and whether the time ran out
+    :rtype: tuple (list, int, bool)
+    """
+    name, start, stop, windows, old_groups, new_groups, min_threshold, max_line_length, deadline, comparison_cost = task
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        counts = array('q')
+        counts.frombytes(memory.buf[:16])
+        ends = array('q')
+        ends.frombytes(memory.buf[16:16 + 8 * (counts[0] + counts[1] + 1)])
+        base = 16 + 8 * len(ends)
+
+        def line(k):
+            return bytes(memory.buf[base + ends[k]:base + ends[k + 1]]).decode("utf-8", "surrogatepass")
+
+        rows = []
+        new_texts = dict()  # new lines decoded so far
+        matchers = dict()  # one SequenceMatcher per new line, as in the serial comparison
+        counter = 0
+        exceeded = False
+        for k in range(start, stop):
+            if deadline is not None and clock() > deadline:
+                exceeded = True
+                break
+            rows.append((k, []))
+            old_text = line(k)
+            if len(old_text) > max_line_length:
+                continue
+            for c in range(windows[k - start][0], windows[k - start][1]):
+                if old_groups is not None and old_groups[k - start] == new_groups[c]:
+                    continue
+                if c not in new_texts:
+                    new_texts[c] = line(counts[0] + c)
+                length = len(old_text) + len(new_texts[c])
+                if len(new_texts[c]) > max_line_length:
+                    continue
+                if 2.0 * min(len(old_text), len(new_texts[c])) / length <= min_threshold:
+                    continue
+                if c not in matchers:
+                    matchers[c] = difflib.SequenceMatcher(None, "", new_texts[c], autojunk=False)
+                line_diff_result = matchers[c]
+                line_diff_result.set_seq1(old_text)
+                if line_diff_result.quick_ratio() <= min_threshold:
+                    continue
+                if deadline is not None:
+                    left = deadline - clock()
+                    if left <= 0:
+                        exceeded = True
+                        break
+                    if len(old_text) * len(new_texts[c]) * comparison_cost > left:
+                        exceeded = True
+                        continue  # the pair cannot be compared in the time left
+                counter += 1
+                ratio = line_diff_result.ratio()
+                if ratio > min_threshold:
+                    rows[-1][1].append((c, ratio, line_diff_result.get_matching_blocks()))
+        return rows, counter, exceeded
+    finally:
+        memory.close()
+
+
+class ComparisonPool:
+    """Pool of processes comparing the changed lines of huge revisions in parallel
+    The comparisons of an update() are split in contiguous ranges of old lines, the lines are shared with the processes
+    through shared memory and the candidate pairs are put back together in the order of the old lines, so that the
+    best matches picked are exactly those of the serial comparison. Updates with fewer than min_comparisons pairs to
+    check are compared by the calling process, where starting the work in other processes would cost more than it
+    saves. The processes are started on first use and a pool can be shared by several GitPersistence instances.
+    """
+
+    def __init__(self, processes=None, min_comparisons=100000, chunks_per_process=4):
+        """ Initializes the pool, its processes are started by the first comparison
+
+        :param processes: number of processes (number of CPUs if None)
+        :type processes: int
+        :param min_comparisons: estimated pairs of lines an update() must have to check to use the pool
+        :type min_comparisons: int
+        :param chunks_per_process: ranges of old lines given to every process, more ranges balance the work better
+        :type chunks_per_process: int
+
+        :return: None
+        :rtype: None
+        """
+        self.processes = processes if processes is not None else os.cpu_count() or 1
+        self.min_comparisons = min_comparisons
+        self.chunks_per_process = chunks_per_process
+        self.pool = None
+
+    def __enter__(self):
+        """ Use the pool in a with block, its processes are stopped at the end """
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """ Stop the processes, exceptions are propagated """
+        self.close()
+        return False
+
+    def accepts(self, pairs):
+        """ Whether comparisons are worth sending to the pool
+
+        :param pairs: estimated number of pairs of lines to check
+        :type pairs: int
+
+        :return: True if the pool should compare them
+        :rtype: bool
+        """
+        return self.processes > 1 and pairs >= self.min_comparisons
+
+    def compare(self, old_texts, new_texts, windows, old_groups, new_groups, min_threshold, max_line_length,
+                deadline=None, comparison_cost=0.0):
+        """ Compare every old line with a range of new lines
+
+        :param old_texts: old lines to compare
+        :type old_texts: list
+        :param new_texts: new lines they can be compared with
+        :type new_texts: list
+        :param windows: (first, last + 1) new line to compare with every old line
+        :type windows: list
+        :param old_groups: optional group of every old line, pairs of lines from the same group are not compared
+        :type old_groups: list
+        :param new_groups: optional group of every new line
+        :type new_groups: list
+        :param min_threshold: a percentage of similarity for line by line comparisons
+        :type min_threshold: float bound between 0.0 to 1.0
+        :param max_line_length: lines longer than this are not compared
+        :type max_line_length: int
+        :param deadline: time (clock()) after which no more lines are compared (no limit if None)
+        :type deadline: float
+        :param comparison_cost: estimated seconds of a comparison per pair of characters, pairs that cannot be compared
+         before the deadline are skipped
+        :type comparison_cost: float
+
+        :return: old line and candidate pairs (new line, ratio, matching blocks) of every old line compared, in order
+         of the old lines, number of comparisons made and whether the time ran out (old lines left are not returned)
+        :rtype: tuple (list, int, bool)
+        """
+        if self.pool is None:
+            if os.name == "posix":  # processes forked before the tracker of shared memory would each start their own
+                resource_tracker.ensure_running()
+            self.pool = multiprocessing.Pool(self.processes)
+        memory = _share_lines(old_texts, new_texts)
+        try:
+            size = max(1, -(-len(old_texts) // (self.processes * self.chunks_per_process)))
+            tasks = []
+            for start in range(0, len(old_texts), size):
+                stop = min(start + size, len(old_texts))
+                tasks.append((memory.name, start, stop, windows[start:stop],
+                              None if old_groups is None else old_groups[start:stop], new_groups, min_threshold,
+                              max_line_length, deadline, comparison_cost))
+            rows = []
+            counter = 0
+            exceeded = False
+            for task_rows, task_counter, task_exceeded in self.pool.map(_compare, tasks):
+                rows.extend(task_rows)
+                counter += task_counter
+                exceeded = exceeded or task_exceeded
+            return rows, counter, exceeded
+        finally:
+            memory.close()
+            memory.unlink()
+
+    def close(self):
+        """ Stop the processes of the pool
+
+        :return: None
+        :rtype: None
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -1,40 +1,272 @@
 import difflib
 from difflib import Match
 import hashlib
+import io
+import struct
+import sys
+import zlib
+from array import array
+from html import escape
+import heapq
 import random
 import math
-from collections import Counter
+import time
+from collections import deque
+from itertools import accumulate
+from bisect import bisect_left
+from .attribution import AttributionSpans, NumpyAttribution
+from .metrics import NULL_METRICS
+from .match_cache import MatchCache
+from . import comparison_pool
 
 
 class GitPersistence:
     """Tracks commit code ownership through different updates
     Name for package is git-persistence, however th class in Python is named as such to comply with PEP8 specs
+    All state is kept per instance. Users are interned: each distinct user is stored once and commits refer to it by an
+    integer id.
     """
-    code = []
-    code_text = ""
-    commit_no = 0
+    backends = {"python": AttributionSpans, "numpy": NumpyAttribution}
 
-    new_code = []
-    new_code_text = ""
-    new_commit_no = 0
+    # Strategies of update(): "char" compares every pair of changed lines character by character, "chunked" only
+    # compares lines within chunk_window positions of each other and "line" only matches identical lines (changed lines
+    # are attributed to the new revision). "auto" picks the most precise strategy whose estimated number of line
+    # comparisons stays under max_comparisons, lines longer than comparison_line_length count as several lines.
+    strategies = ["auto", "char", "chunked", "line"]
+    max_comparisons = 1000000
+    comparison_line_length = 80
+    chunk_window = 100
+    max_line_length = 20000  # longer lines (e.g. minified code) are only matched when identical
+    comparison_cost = 5e-8  # estimated seconds of a comparison per pair of characters, pairs that cannot be compared
+    # in the time left of time_budget are skipped
 
-    user_index = dict()
+    # Snapshot format (see save()), all numbers are little-endian
+    snapshot_magic = b"GPST"
+    snapshot_version = 1
 
-    def __init__(self, rev, user):
+    html_header = """<html><head><style>
+    [tooltip]:before {
+    /* needed - do not touch */
+    content: attr(tooltip);
+    position: absolute;
+    opacity: 0;
+
+    /* customizable */
+    transition: all 0.15s ease;
+    padding: 10px;
+    color: #333;
+    border-radius: 10px;
+    box-shadow: 2px 2px 1px silver;    
+    }
+
+    [tooltip]:hover:before {
+    /* needed - do not touch */
+    opacity: 1;
+
+    /* customizable */
+    background: yellow;
+    margin-top: -50px;
+    margin-left: 20px;    
+    }
+
+    [tooltip]:not([tooltip-persistent]):before {
+    pointer-events: none;
+    }
+    """
+
+    def __init__(self, rev, user, backend="python", metrics=None, strategy="auto", time_budget=None, match_cache=None,
+                 pool=None, origins=None):
         """ Initializes the class by receiving the first state of code
 
         :param rev: string containing code
         :type rev: str
         :param user: user that has submitted the first code
         :type user: bytes
+        :param backend: attribution storage, "python" (run-length encoded spans) or "numpy" (requires numpy)
+        :type backend: str
+        :param metrics: counters and timers of the phases of every update (disabled if None)
+        :type metrics: git_persistence.metrics.Metrics
+        :param strategy: matching strategy of update(), one of strategies
+        :type strategy: str
+        :param time_budget: seconds an update() can spend comparing changed lines, lines left when the budget runs out
+         are attributed to the new revision (unlimited if None)
+        :type time_budget: float
+        :param match_cache: cache of line comparisons, pass the same cache to several instances to share it (a cache
+         of the instance is created if None)
+        :type match_cache: git_persistence.match_cache.MatchCache
+        :param pool: processes comparing the changed lines of huge revisions, results are the same as without a pool
+         (every line is compared by the calling process if None)
+        :type pool: git_persistence.comparison_pool.ComparisonPool
+        :param origins: spans of rev written by other users (e.g. code moved from another file, see LineIndex), tuples
+         of (start, length, user) in increasing order of start. Every user gets a commit of its own before the commit
+         of user, so that the spans keep their authors, and all these commits are as old as a single commit.
+        :type origins: list
 
         :return: None
         :rtype: None
         """
+        self.__configure(backend, metrics, strategy, time_budget, match_cache, pool)
+        origin_commits = dict()  # user -> virtual commit number
+        for start, length, origin_user in origins or ():
+            if origin_user not in origin_commits:
+                self.commit_no += 1
+                self.commit_users.append(self.__intern(origin_user))
+                origin_commits[origin_user] = self.commit_no
+        self.origin_commits = self.commit_no
         self.__pre_process_revision(rev, user)
-        self.__insert_commits(0, len(rev), self.new_commit_no)
+        pointer = 0
+        for start, length, origin_user in origins or ():
+            if start > pointer:
+                self.__insert_commits(pointer, start, self.new_commit_no)
+            self.__insert_commits(start, start + length, origin_commits[origin_user])
+            pointer = start + length
+        self.__insert_commits(pointer, len(rev), self.new_commit_no)
         self.__commit()
 
+    def __configure(self, backend, metrics, strategy, time_budget, match_cache, pool):
+        """ Set up the options and the empty state of an instance
+
+        :param backend: attribution storage, "python" (run-length encoded spans) or "numpy" (requires numpy)
+        :type backend: str
+        :param metrics: counters and timers of the phases of every update (disabled if None)
+        :type metrics: git_persistence.metrics.Metrics
+        :param strategy: matching strategy of update(), one of strategies
+        :type strategy: str
+        :param time_budget: seconds an update() can spend comparing changed lines (unlimited if None)
+        :type time_budget: float
+        :param match_cache: cache of line comparisons (a cache of the instance is created if None)
+        :type match_cache: git_persistence.match_cache.MatchCache
+        :param pool: processes comparing the changed lines of huge revisions (none if None)
+        :type pool: git_persistence.comparison_pool.ComparisonPool
+
+        :return: None
+        :rtype: None
+        """
+        if backend not in self.backends:
+            raise ValueError("Unknown backend '%s', expected one of %s" % (backend, ", ".join(sorted(self.backends))))
+        if strategy not in self.strategies:
+            raise ValueError("Unknown strategy '%s', expected one of %s" % (strategy, ", ".join(self.strategies)))
+        self.attribution = self.backends[backend]
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.strategy = strategy
+        self.time_budget = time_budget
+        self.match_cache = match_cache if match_cache is not None else MatchCache()
+        self.pool = pool
+        self.last_strategy = None  # strategy used by the last update()
+        self.last_budget_exceeded = False  # whether the last update() ran out of time_budget
+        self.code = self.attribution()
+        self.code_text = ""
+        self.code_lines = None  # code_text split in lines and the start of every line, kept from the last update()
+        self.code_starts = None
+        self.commit_no = 0
+        self.origin_commits = 0  # commits 1 to origin_commits credit the origins of the first revision, as old as one
+        self.new_code = self.code
+        self.new_code_text = ""
+        self.new_code_lines = None
+        self.new_code_starts = None
+        self.new_commit_no = 0
+        self.users = []  # user id -> user
+        self.user_ids = dict()  # user -> user id
+        self.commit_users = array('i', [-1])  # commit number -> user id, commit numbers start at 1
+
+    def __intern(self, user):
+        """ Obtain the id of a user, adding the user if new
+
+        :param user: user that submitted a revision
+        :type user: bytes
+
+        :return: user id
+        :rtype: int
+        """
+        user_id = self.user_ids.get(user)
+        if user_id is None:
+            user_id = len(self.users)
+            self.users.append(user)
+            self.user_ids[user] = user_id
+        return user_id
+
+    def save(self, stream):
+        """ Write a compact binary snapshot of the state after last update(): commit number, number of origin commits,
+        users, user id of every commit, attribution runs and the current text (compressed), so that tracking can resume
+        later with load()
+
+        :param stream: binary file-like object with a write() method
+        :type stream: io.BufferedIOBase
+
+        :return: None
+        :rtype: None
+        """
+        commit_users = array('i', self.commit_users[1:self.commit_no + 1])
+        commits = array('I')
+        lengths = array('Q')
+        for x, length in self.code.runs():
+            commits.append(x)
+            lengths.append(length)
+        if sys.byteorder == "big":
+            commit_users.byteswap()
+            commits.byteswap()
+            lengths.byteswap()
+        text = zlib.compress(self.code_text.encode("utf-8", "surrogatepass"))
+        stream.write(struct.pack("<4sHII", self.snapshot_magic, self.snapshot_version, self.commit_no, len(commits)))
+        stream.write(struct.pack("<I", self.origin_commits))
+        stream.write(struct.pack("<I", len(self.users)))
+        for user in self.users:
+            stream.write(struct.pack("<I", len(user)) + user)
+        stream.write(commit_users.tobytes())
+        stream.write(commits.tobytes())
+        stream.write(lengths.tobytes())
+        stream.write(struct.pack("<Q", len(text)) + text)
+
+    @classmethod
+    def load(cls, stream, backend="python", metrics=None, strategy="auto", time_budget=None, match_cache=None,
+             pool=None):
+        """ Restore an instance from a snapshot written by save()
+
+        :param stream: binary file-like object with a read() method
+        :type stream: io.BufferedIOBase
+        :param backend: attribution storage, "python" (run-length encoded spans) or "numpy" (requires numpy)
+        :type backend: str
+        :param metrics: counters and timers of the phases of every update (disabled if None)
+        :type metrics: git_persistence.metrics.Metrics
+        :param strategy: matching strategy of update(), one of strategies
+        :type strategy: str
+        :param time_budget: seconds an update() can spend comparing changed lines (unlimited if None)
+        :type time_budget: float
+        :param match_cache: cache of line comparisons (a cache of the instance is created if None)
+        :type match_cache: git_persistence.match_cache.MatchCache
+        :param pool: processes comparing the changed lines of huge revisions (none if None)
+        :type pool: git_persistence.comparison_pool.ComparisonPool
+
+        :return: instance in the same state as the one saved
+        :rtype: GitPersistence
+        """
+        magic, version, commit_no, runs = struct.unpack("<4sHII", stream.read(14))
+        if magic != cls.snapshot_magic or version != cls.snapshot_version:
+            raise ValueError("Not a GitPersistence snapshot of version %s (read %s version %s)"
+                             % (str(cls.snapshot_version), repr(magic), str(version)))
+        tracking = cls.__new__(cls)
+        tracking.__configure(backend, metrics, strategy, time_budget, match_cache, pool)
+        tracking.origin_commits = struct.unpack("<I", stream.read(4))[0]
+        for x in range(0, struct.unpack("<I", stream.read(4))[0]):
+            tracking.__intern(stream.read(struct.unpack("<I", stream.read(4))[0]))
+        commit_users = array('i')
+        commit_users.frombytes(stream.read(commit_no * commit_users.itemsize))
+        if sys.byteorder == "big":
+            commit_users.byteswap()
+        tracking.commit_users.extend(commit_users)
+        commits = array('I')
+        lengths = array('Q')
+        commits.frombytes(stream.read(runs * commits.itemsize))
+        lengths.frombytes(stream.read(runs * lengths.itemsize))
+        if sys.byteorder == "big":
+            commits.byteswap()
+            lengths.byteswap()
+        text = zlib.decompress(stream.read(struct.unpack("<Q", stream.read(8))[0]))
+        tracking.code = tracking.attribution.from_runs(commits, lengths)
+        tracking.code_text = text.decode("utf-8", "surrogatepass")
+        tracking.commit_no = commit_no
+        return tracking
+
     def __pre_process_revision(self, rev, user):
         """ Initialize variables
 
@@ -47,9 +279,12 @@ class GitPersistence:
         :rtype: None
         """
         self.new_code_text = rev
+        self.new_code_lines = None
+        self.new_code_starts = None
         self.new_commit_no = self.commit_no + 1
-        self.new_code = []
-        self.user_index[self.new_commit_no] = user
+        self.new_code = self.attribution()
+        del self.commit_users[self.new_commit_no:]  # entry left by an update that did not complete
+        self.commit_users.append(self.__intern(user))
 
     def __commit(self):
         """ Commits changes from new to current variables, variable switching
@@ -59,10 +294,12 @@ class GitPersistence:
         """
         self.code = self.new_code
         self.code_text = self.new_code_text
+        self.code_lines = self.new_code_lines
+        self.code_starts = self.new_code_starts
         self.commit_no = self.new_commit_no
 
     def __insert_commits(self, start, stop, number):
-        """ Insert in list 'numbers' that have a value based on the revision
+        """ Insert a span of characters that have a value based on the revision
 
         :param start: almost always zero
         :type start: int
@@ -74,11 +311,10 @@ class GitPersistence:
         :return: None
         :rtype: None
         """
-        for x in range(start, stop):
-            self.new_code.append(number)
+        self.new_code.append(number, stop - start)
 
     def __add_match_blocks(self, a, length):  #
-        """ Apply existing numeric value to each character based on the previous code's matched block
+        """ Apply existing numeric values to the characters of the previous code's matched block (copied as spans)
 
         :param a: start position on old revision
         :type a: int
@@ -88,13 +324,332 @@ class GitPersistence:
         :return: None
         :rtype: None
         """
-        for x in range(0, length):
-            self.new_code.append(self.code[x + a])
+        self.new_code.extend_from(self.code, a, length)
+
+    def __anchor_lines(self, original, new):
+        """ Anchor unchanged regions with a patience line diff. Identical leading and trailing lines are matched first,
+        then lines that appear exactly once on both sides are matched through their longest increasing subsequence and
+        the same is repeated within every region left between two anchors.
+
+        :param original: lines of the previous revision
+        :type original: list
+        :param new: lines of the new revision
+        :type new: list
+
+        :return: pairs of identical lines in increasing order of both positions
+        :rtype: list [(line in original, line in new),(),()...]
+        """
+        anchors = []
+        regions = [(0, len(original), 0, len(new))]  # regions that still need anchoring (used as a stack)
+        while len(regions) > 0:
+            x_start, x_stop, y_start, y_stop = regions.pop()
+            while x_start < x_stop and y_start < y_stop and original[x_start] == new[y_start]:
+                anchors.append((x_start, y_start))
+                x_start += 1
+                y_start += 1
+            while x_start < x_stop and y_start < y_stop and original[x_stop - 1] == new[y_stop - 1]:
+                x_stop -= 1
+                y_stop -= 1
+                anchors.append((x_stop, y_stop))
+            if x_start == x_stop or y_start == y_stop:
+                continue
+
+            # Lines that occur exactly once on each side: line -> [count in original, x, count in new, y]
+            occurrences = dict()
+            for x in range(x_start, x_stop):
+                if original[x] in occurrences:
+                    occurrences[original[x]][0] += 1
+                else:
+                    occurrences[original[x]] = [1, x, 0, 0]
+            for y in range(y_start, y_stop):
+                if new[y] in occurrences:
+                    occurrences[new[y]][2] += 1
+                    occurrences[new[y]][3] = y
+            unique = sorted((o[1], o[3]) for o in occurrences.values() if o[0] == 1 and o[2] == 1)
+            if len(unique) == 0:
+                continue
+
+            # Longest increasing subsequence of new line positions (patience sorting)
+            pile_tops = []  # position in new of the top card of each pile
+            pile_cards = []  # index in unique of the top card of each pile
+            previous = []  # index in unique of the top card of the previous pile when a card was placed
+            for i in range(0, len(unique)):
+                pile = bisect_left(pile_tops, unique[i][1])
+                previous.append(pile_cards[pile - 1] if pile > 0 else -1)
+                if pile == len(pile_tops):
+                    pile_tops.append(unique[i][1])
+                    pile_cards.append(i)
+                else:
+                    pile_tops[pile] = unique[i][1]
+                    pile_cards[pile] = i
+            sequence = []
+            i = pile_cards[-1]
+            while i != -1:
+                sequence.append(unique[i])
+                i = previous[i]
+            sequence.reverse()
+
+            # Regions between two consecutive anchors are anchored in turn
+            for x, y in sequence:
+                anchors.append((x, y))
+                regions.append((x_start, x, y_start, y))
+                x_start = x + 1
+                y_start = y + 1
+            regions.append((x_start, x_stop, y_start, y_stop))
+        anchors.sort()
+        return anchors
+
+    def __match_lines(self, original, new, old_lines, new_lines, min_threshold, old_groups=None, new_groups=None,
+                      strategy="char", deadline=None):
+        """ Find the best matching pairs between a set of old lines and a set of new lines using an exact
+        hash-multiset pass and a similarity metric (difflib) for every other pair (see strategies)
+
+        :param original: lines of the previous revision
+        :type original: list
+        :param new: lines of the new revision
+        :type new: list
+        :param old_lines: line numbers in original that can be matched
+        :type old_lines: list
+        :param new_lines: line numbers in new that can be matched
+        :type new_lines: list
+        :param min_threshold: a percentage of similarity for line by line comparisons
+        :type min_threshold: float bound between 0.0 to 1.0
+        :param old_groups: optional group of each old line, pairs of lines from the same group are not compared
+        :type old_groups: list
+        :param new_groups: optional group of each new line
+        :type new_groups: list
+        :param strategy: "char", "chunked" or "line"
+        :type strategy: str
+        :param deadline: time (time.perf_counter()) after which no more lines are compared (no limit if None)
+        :type deadline: float
+
+        :return: matched lines and the number of comparisons made
+        :rtype: tuple ([[line in original, line in new, matching blocks within line],[],[]...], int)
+        """
+        line_matches = []
+
+        # Match identification code below
+        # worst-case: O(x*y) or O(x^2) if x and y equal length and changes existing in all lines
+        # best-case: O(x)
+
+        # Constructing a map from line content to a queue of its remaining positions in new_lines to match identical
+        # lines in O(1) each (the first remaining occurrence is always taken)
+        with self.metrics.timer("exact_match"):
+            positions = dict()
+            for y in range(0, len(new_lines)):
+                if new[new_lines[y]] in positions:
+                    positions[new[new_lines[y]]].append(y)
+                else:
+                    positions[new[new_lines[y]]] = deque([y])
+            exact = [False] * len(new_lines)  # whether each of new_lines was matched as an identical line
+            fuzzy = []  # old lines that have no identical line left
+            for i in range(0, len(old_lines)):
+                x = old_lines[i]
+                if len(positions.get(original[x], ())) > 0:
+                    y = positions[original[x]].popleft()
+                    exact[y] = True
+                    # Identical lines always match as a whole, so there is no need to compare them with difflib
+                    line_matches.append([x, new_lines[y], [Match(a=0, b=0, size=len(original[x])),
+                                                           Match(a=len(original[x]), b=len(original[x]), size=0)]])
+                else:
+                    fuzzy.append(i)
+            del positions
+            y_list = [y for y in range(0, len(new_lines)) if not exact[y]]  # new lines left, in order
+        self.metrics.count("exact_matches", len(line_matches))
+
+        with self.metrics.timer("fuzzy_compare"):
+            diffs = []
+            matchers = dict()  # one SequenceMatcher per new line, so that its analysis is reused for every old line
+            counter = 0
+            hits = self.match_cache.hits
+            if strategy == "line":
+                fuzzy = []
+            # Once time_budget ran out (e.g. in the gaps before the moved lines), the pool is not started again
+            elif self.pool is not None and not self.last_budget_exceeded and self.pool.accepts(
+                    len(fuzzy) * (len(y_list) if strategy == "char" else min(len(y_list), 2 * self.chunk_window + 1))):
+                diffs, counter = self.__compare_in_pool(original, new, old_lines, new_lines, fuzzy, y_list,
+                                                        min_threshold, old_groups, new_groups, strategy, deadline)
+                fuzzy = []  # already compared by the pool
+            # No duplicate so we have to compare the item with the rest of the list (code modified or removed)
+            for i in fuzzy:
+                if deadline is not None and time.perf_counter() > deadline:
+                    self.last_budget_exceeded = True
+                    break
+                x = old_lines[i]
+                diffs.append([])
+                if len(original[x]) > self.max_line_length:
+                    continue
+                candidates = y_list
+                if strategy == "chunked":  # new lines around the position of the old line, relative to their lengths
+                    k = bisect_left(y_list, i * len(new_lines) // len(old_lines))
+                    candidates = y_list[max(0, k - self.chunk_window):k + self.chunk_window + 1]
+                for y in candidates:
+                    if old_groups is not None and old_groups[i] == new_groups[y]:
+                        continue  # already compared within their own group
+                    # Only pairs above min_threshold can ever be picked, so cheap upper bounds of the ratio are
+                    # checked first: the length ratio bound, then the character multiset bound (quick_ratio)
+                    length = len(original[x]) + len(new[new_lines[y]])
+                    if len(new[new_lines[y]]) > self.max_line_length:
+                        continue
+                    if 2.0 * min(len(original[x]), len(new[new_lines[y]])) / length <= min_threshold:
+                        continue
+                    if y not in matchers:  # the new line is the cached second sequence of its matcher
+                        matchers[y] = difflib.SequenceMatcher(None, "", new[new_lines[y]], autojunk=False)
+                    line_diff_result = matchers[y]
+                    line_diff_result.set_seq1(original[x])
+                    if line_diff_result.quick_ratio() <= min_threshold:
+                        continue
+                    # The same pair of lines may have been compared by a previous revision
+                    cached = self.match_cache.get(original[x], new[new_lines[y]])
+                    if cached is None:
+                        if deadline is not None:
+                            left = deadline - time.perf_counter()
+                            if left <= 0:
+                                self.last_budget_exceeded = True
+                                break
+                            if len(original[x]) * len(new[new_lines[y]]) * self.comparison_cost > left:
+                                self.last_budget_exceeded = True
+                                continue  # the pair cannot be compared in the time left
+                        counter += 1
+                        cached = (line_diff_result.ratio(), line_diff_result.get_matching_blocks())
+                        self.match_cache.put(original[x], new[new_lines[y]], cached[0], cached[1])
+                    # matching blocks only for pairs that can be picked
+                    if cached[0] > min_threshold:
+                        diffs[-1].append([x, new_lines[y], cached[0], cached[1]])
+        self.metrics.count("comparisons", counter)
+        self.metrics.count("match_cache_hits", self.match_cache.hits - hits)
+
+        # Pick the best matches greedily from a priority queue of all candidate pairs, ordered by decreasing ratio
+        # (ties are resolved in the order of old lines and then of new lines). Once a pair is picked, both of its
+        # lines are consumed and every other candidate that involves one of them is skipped when popped.
+        with self.metrics.timer("best_match_selection"):
+            candidates = []
+            for i in range(0, len(diffs)):
+                for j in range(0, len(diffs[i])):
+                    if diffs[i][j][2] > min_threshold:
+                        candidates.append((-diffs[i][j][2], i, j))
+            heapq.heapify(candidates)
+            consumed_old = set()  # rows of diffs (old lines) already matched
+            consumed_new = set()
+            while len(candidates) > 0:
+                ratio, i, j = heapq.heappop(candidates)
+                if i in consumed_old or diffs[i][j][1] in consumed_new:
+                    continue
+                # we found a line that looks similar enough and was likely moved
+                line_matches.append([diffs[i][j][0], diffs[i][j][1], diffs[i][j][3]])
+                consumed_old.add(i)
+                consumed_new.add(diffs[i][j][1])
+        self.metrics.count("fuzzy_matches", len(consumed_old))
+        return line_matches, counter
+
+    def __compare_in_pool(self, original, new, old_lines, new_lines, fuzzy, y_list, min_threshold, old_groups,
+                          new_groups, strategy, deadline):
+        """ Compare the old lines left after the exact pass in the processes of the pool. The same pairs as in the
+        serial comparison of __match_lines() are checked, the pairs found are added to the match cache (the pool
+        does not look it up) and the deadline is given to the processes on the clock they share.
+
+        :param original: lines of the previous revision
+        :type original: list
+        :param new: lines of the new revision
+        :type new: list
+        :param old_lines: line numbers in original that can be matched
+        :type old_lines: list
+        :param new_lines: line numbers in new that can be matched
+        :type new_lines: list
+        :param fuzzy: positions in old_lines of the lines to compare
+        :type fuzzy: list
+        :param y_list: positions in new_lines of the lines they can be compared with
+        :type y_list: list
+        :param min_threshold: a percentage of similarity for line by line comparisons
+        :type min_threshold: float bound between 0.0 to 1.0
+        :param old_groups: optional group of each old line, pairs of lines from the same group are not compared
+        :type old_groups: list
+        :param new_groups: optional group of each new line
+        :type new_groups: list
+        :param strategy: "char" or "chunked"
+        :type strategy: str
+        :param deadline: time (time.perf_counter()) after which no more lines are compared (no limit if None)
+        :type deadline: float
+
+        :return: candidate pairs of every old line compared (see __match_lines()) and the number of comparisons made
+        :rtype: tuple ([[[line in original, line in new, ratio, matching blocks],[],...],[],...], int)
+        """
+        windows = []
+        for i in fuzzy:
+            if strategy == "chunked":
+                k = bisect_left(y_list, i * len(new_lines) // len(old_lines))
+                windows.append((max(0, k - self.chunk_window), min(len(y_list), k + self.chunk_window + 1)))
+            else:
+                windows.append((0, len(y_list)))
+        if deadline is not None:
+            deadline = comparison_pool.clock() + deadline - time.perf_counter()
+        rows, counter, exceeded = self.pool.compare([original[old_lines[i]] for i in fuzzy],
+                                                    [new[new_lines[y]] for y in y_list], windows,
+                                                    None if old_groups is None else [old_groups[i] for i in fuzzy],
+                                                    None if new_groups is None else [new_groups[y] for y in y_list],
+                                                    min_threshold, self.max_line_length, deadline,
+                                                    self.comparison_cost)
+        if exceeded:
+            self.last_budget_exceeded = True
+        diffs = []
+        for k, pairs in rows:
+            x = old_lines[fuzzy[k]]
+            diffs.append([])
+            for c, ratio, blocks in pairs:
+                y = new_lines[y_list[c]]
+                self.match_cache.put(original[x], new[y], ratio, blocks)
+                diffs[-1].append([x, y, ratio, blocks])
+        self.metrics.count("pooled_comparisons", counter)
+        return diffs, counter
+
+    def __choose_strategy(self, old_lines, new_lines, old_chars, new_chars):
+        """ Pick the most precise strategy whose estimated number of line comparisons is under max_comparisons. The
+        cost of comparing two lines grows with their lengths, so lines are weighted by their number of characters
+        (a line of comparison_line_length characters or less counts as one line).
+
+        :param old_lines: number of lines of the previous revision left after anchoring
+        :type old_lines: int
+        :param new_lines: number of lines of the new revision left after anchoring
+        :type new_lines: int
+        :param old_chars: number of characters of these lines of the previous revision
+        :type old_chars: int
+        :param new_chars: number of characters of these lines of the new revision
+        :type new_chars: int
+
+        :return: "char", "chunked" or "line"
+        :rtype: str
+        """
+        old_weight = max(old_lines, old_chars / self.comparison_line_length)
+        new_weight = max(new_lines, new_chars / self.comparison_line_length)
+        if old_weight * new_weight <= self.max_comparisons:
+            return "char"
+        window_weight = min(new_lines, 2 * self.chunk_window + 1) * new_weight / max(1, new_lines)
+        if old_weight * window_weight <= self.max_comparisons:
+            return "chunked"
+        return "line"
+
+    @staticmethod
+    def __split_lines(text):
+        """ Split a text in lines and calculate the start position of each line
+
+        :param text: text of a revision
+        :type text: str
+
+        :return: lines (retaining new line characters) and start position of each line
+        :rtype: tuple (list, list)
+        """
+        lines = text.splitlines(True)
+        starts = [0]
+        starts.extend(accumulate(map(len, lines[:-1])))
+        return lines, starts[:len(lines)]
 
     def __calculate_blocks(self, rev, min_threshold=0.6):
         """ Calculate line by line, which lines have changed based on min_threshold and then
         check for within line changes (char by char) and return which a list of matched code blocks
         that have remained the same.
+        Unchanged regions are anchored first with a patience line diff, so that line comparisons only take place
+        within the gaps left between anchors. Lines left unmatched in their own gap are then compared against lines of
+        the other gaps, so that code moved across the file is still tracked.
 
         :param rev: text of new revision
         :type rev: str
@@ -105,97 +660,91 @@ class GitPersistence:
         :rtype: list [(start position in original text, start pos in new text, length),(),()...]
         """
         matches = []  # contains tuples of matched parts
-        original = self.code_text.splitlines(True)  # original text with split lines (retains \n as a char)
-        new = rev.splitlines(True)  # the new submitted text
-        found = True
-
-        # Calculate start positions for each line in original strings
-        char_start_original = []
-        char_start_new = []
-        additive = 0
-        for x in range(0, len(original)):
-            char_start_original.append(additive)
-            additive += len(original[x])
-        additive = 0
-        for y in range(0, len(new)):
-            char_start_new.append(additive)
-            additive += len(new[y])
+        with self.metrics.timer("line_split"):
+            # The lines of the original text were split by the last update(), the line objects are kept together with
+            # the hashes str computes once and that the anchoring and the match cache look up again
+            if self.code_lines is None:
+                self.code_lines, self.code_starts = self.__split_lines(self.code_text)
+            original = self.code_lines  # original text with split lines (retains \n as a char)
+            char_start_original = self.code_starts
+            new, char_start_new = self.__split_lines(rev)  # the new submitted text
+            self.new_code_lines = new
+            self.new_code_starts = char_start_new
 
-        # Match identification code below
-        # worst-case: O(x*y) or O(x^2) if x and y equal length and changes existing in all lines
-        # best-case: O(x)
+        # Unchanged lines found by the line diff match as a whole
+        with self.metrics.timer("anchor"):
+            anchors = self.__anchor_lines(original, new)
+        self.metrics.count("anchors", len(anchors))
 
-        # Constructing a hash-multiset to speed the process later on
-        cnt = Counter()
-        for word in new:
-            cnt[word] += 1
+        # Lines left by anchoring may all have to be compared (the moves pass compares lines across gaps)
+        strategy = self.strategy
+        if strategy == "auto":
+            strategy = self.__choose_strategy(len(original) - len(anchors), len(new) - len(anchors),
+                                              len(self.code_text) - sum(len(original[x]) for x, y in anchors),
+                                              len(rev) - sum(len(new[y]) for x, y in anchors))
+        self.last_strategy = strategy
+        self.last_budget_exceeded = False
+        self.metrics.count("strategy_" + strategy)
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.perf_counter() + self.time_budget
+        line_matches = [[x, y, [Match(a=0, b=0, size=len(original[x]))]] for x, y in anchors]
 
-        diffs = []
-        new_tmp = new  # Temporary object that we modify on the fly, used for reference
-        y_list = list(range(0, len(new)))  # Temporary object for dynamic recursion
+        # Matching lines within each gap left between two anchors (or before the first and after the last anchor)
+        unmatched_old = []
+        unmatched_new = []
+        old_groups = []  # gap number of each unmatched line
+        new_groups = []
         counter = 0
-        for x in range(0, len(original)):
-            diffs.append([])
-            if cnt[original[x]] > 0:  # it exists (this is O(1) which helps skip a lot of comparisons)
-                y = y_list.index(new_tmp.index(original[x]))  # reference index number in y_list (iterable)
-                # Adding a matched record that simulates what difflib would find if it were to compare the two strings
-                # Basically the whole new line matches the old, difflib always has a zero size match as the last
-                # element.
-                diffs[x].append([x, y_list[y], 1.0,
-                                 [Match(a=0, b=0, size=len(original[x])),
-                                  Match(a=len(original[x]), b=len(original[x]), size=0)]
-                                 ])
-                del (y_list[y])  # delete the existing object's line
-                # This is like deleting the record for the purposes of retrieving the index from the tmp object.
-                # Deleting would have shifted the numbers
-                new_tmp[new_tmp.index(original[x])] = 0
-                cnt[original[x]] -= 1  # decrement
-            else:  # no duplicate so we have to compare the item with the rest of the list (code modified or removed)
-                for y in range(0, len(y_list)):
-                    counter += 1
-                    line_diff_result = difflib.SequenceMatcher(None, original[x], new[y_list[y]], autojunk=False)
-                    # Sanity check below, the hash-multiset should have removed all identical lines
-                    if line_diff_result.ratio() == 1:
-                        diffs[x].append([x, y_list[y], line_diff_result.ratio(),
-                                         line_diff_result.get_matching_blocks()])
-                        del (y_list[y])
-                        break
-                    else:
-                        diffs[x].append([x, y_list[y], line_diff_result.ratio(),
-                                         line_diff_result.get_matching_blocks()])
-        print(
-            "Total comparisons: " + str(counter))  # For visually seeing whether the optimizations work and we avoid n^2
-        del cnt
-        del new_tmp
-
-        # Iterate through all the calculated diffs and figure out the best matches
-        # The look keeps going on and on until all possible matches are found (could be rewritten as a recursive func)
-        # to_delete serves a deleting agent so that after a match is appended, the lines found to match are eliminated
-        # from further consideration
-        to_delete = -999  # init a non-sense number
-        while found is True:
-            found = False
-            max_match = [0, 0, 0, 0]  # This will hold the best match between line_x and line_y
-            for x in range(0, len(diffs)):
-                for y in range(0, len(diffs[x])):
-                    if diffs[x][y][1] == to_delete:
-                        diffs[x][y] = [0, 0, 0, 0]
-                    else:
-                        if diffs[x][y][2] > min_threshold and max_match[2] < diffs[x][y][2]:
-                            max_match = [diffs[x][y][0], diffs[x][y][1], diffs[x][y][2], diffs[x][y][3], x]
-            if max_match[2] != 0:  # we found a line that looks similar enough and was likely moved
-                found = True
-                for m in max_match[3]:
-                    if m[2] != 0:  # make sure that the matched content matches at least 1 char (sanity check)
-                        matches.append([char_start_original[max_match[0]] + m[0],
-                                        char_start_new[max_match[1]] + m[1],
-                                        m[2]])
-                del (diffs[max_match[4]])
-                to_delete = max_match[1]
+        x_start = 0
+        y_start = 0
+        anchors.append((len(original), len(new)))  # sentinel closing the last gap
+        for gap in range(0, len(anchors)):
+            old_lines = list(range(x_start, anchors[gap][0]))
+            new_lines = list(range(y_start, anchors[gap][1]))
+            x_start = anchors[gap][0] + 1
+            y_start = anchors[gap][1] + 1
+            matched_old = set()
+            matched_new = set()
+            if len(old_lines) > 0 and len(new_lines) > 0:
+                gap_matches, comparisons = self.__match_lines(original, new, old_lines, new_lines, min_threshold,
+                                                              strategy=strategy, deadline=deadline)
+                counter += comparisons
+                for line_match in gap_matches:
+                    matched_old.add(line_match[0])
+                    matched_new.add(line_match[1])
+                line_matches.extend(gap_matches)
+            for x in old_lines:
+                if x not in matched_old:
+                    unmatched_old.append(x)
+                    old_groups.append(gap)
+            for y in new_lines:
+                if y not in matched_new:
+                    unmatched_new.append(y)
+                    new_groups.append(gap)
+
+        # Lines that were moved to a different gap
+        if len(unmatched_old) > 0 and len(unmatched_new) > 0:
+            moved_matches, comparisons = self.__match_lines(original, new, unmatched_old, unmatched_new, min_threshold,
+                                                            old_groups, new_groups, strategy, deadline)
+            counter += comparisons
+            line_matches.extend(moved_matches)
+
+        if self.last_budget_exceeded:
+            self.metrics.count("time_budget_exceeded")
+
+        for line_match in line_matches:
+            for m in line_match[2]:
+                if m[2] != 0:  # make sure that the matched content matches at least 1 char (sanity check)
+                    matches.append([char_start_original[line_match[0]] + m[0],
+                                    char_start_new[line_match[1]] + m[1],
+                                    m[2]])
         return matches
 
     def update(self, rev, user):
         """Update old code with new code revision and update which revision is character came from
+        The matching strategy used is recorded in last_strategy, and last_budget_exceeded tells whether time_budget ran
+        out (lines not compared by then are attributed to the new revision).
 
         :param rev: text of new revision
         :type rev: str
@@ -210,20 +759,62 @@ class GitPersistence:
         # Code using similarity metric line by line and using LCS within line (difflib)
         matches = self.__calculate_blocks(rev)
 
-        pointer = 0
-        matches = sorted(matches, key=lambda l: l[1])
-        for code_block_match in matches:
-            # Anything before our pointer in matched block is new code, otherwise it must be existing code
-            if code_block_match[1] != pointer and code_block_match[1] < len(self.new_code_text):
-                self.__insert_commits(0, code_block_match[1] - pointer, self.new_commit_no)
-                pointer += code_block_match[1] - pointer  # Shift pointer based on characters added
-            self.__add_match_blocks(code_block_match[0], code_block_match[2])
-            pointer += code_block_match[2]  # Shift pointer by n number of chars from the matched code block
-        # If there was unmatched new code at the end after all code block matches, then it must be new code
-        if len(self.new_code_text) > len(self.new_code):
-            self.__insert_commits(0, len(self.new_code_text) - len(self.new_code), self.new_commit_no)
+        with self.metrics.timer("attribution_rebuild"):
+            pointer = 0
+            matches = sorted(matches, key=lambda l: l[1])
+            for code_block_match in matches:
+                # Anything before our pointer in matched block is new code, otherwise it must be existing code
+                if code_block_match[1] != pointer and code_block_match[1] < len(self.new_code_text):
+                    self.__insert_commits(0, code_block_match[1] - pointer, self.new_commit_no)
+                    pointer += code_block_match[1] - pointer  # Shift pointer based on characters added
+                self.__add_match_blocks(code_block_match[0], code_block_match[2])
+                pointer += code_block_match[2]  # Shift pointer by n number of chars from the matched code block
+            # If there was unmatched new code at the end after all code block matches, then it must be new code
+            if len(self.new_code_text) > len(self.new_code):
+                self.__insert_commits(0, len(self.new_code_text) - len(self.new_code), self.new_commit_no)
         self.__commit()
 
+    def updates(self, revisions, log_base=10):
+        """ Update with every revision of an iterable and yield the ownership after each one (see calculate_ownership())
+        Revisions are consumed lazily, so that they can be streamed (e.g. read from git one at a time).
+
+        :param revisions: tuples of (text of the revision, user that submitted it)
+        :type revisions: collections.Iterable
+        :param log_base: base for logarithm that helps curve the influence of older commits
+        :type log_base: int
+
+        :return: [sums, avg_persistence] after every revision
+        :rtype: generator
+        """
+        for rev, user in revisions:
+            self.update(rev, user)
+            yield self.calculate_ownership(log_base)
+
+    @classmethod
+    def replay(cls, revisions, log_base=10, **options):
+        """ Track a whole history: the first revision creates an instance that is updated with the following ones, the
+        ownership is yielded after every revision (including the first one)
+        for sums, avg_persistence in GitPersistence.replay(revisions): ...
+
+        :param revisions: tuples of (text of the revision, user that submitted it)
+        :type revisions: collections.Iterable
+        :param log_base: base for logarithm that helps curve the influence of older commits
+        :type log_base: int
+        :param options: backend, metrics, strategy, time_budget, match_cache, pool and origins (see GitPersistence(),
+         origins are spans of the first revision)
+        :type options: dict
+
+        :return: [sums, avg_persistence] after every revision
+        :rtype: generator
+        """
+        revisions = iter(revisions)
+        first = next(revisions, None)
+        if first is None:
+            return
+        tracking = cls(first[0], first[1], **options)
+        yield tracking.calculate_ownership(log_base)
+        yield from tracking.updates(revisions, log_base)
+
     def calculate_ownership(self, log_base=10):
         """Calculate ownership summarized statistics for the last commit
 
@@ -236,32 +827,36 @@ class GitPersistence:
         avg_persistence: provides the mean persistence score for each character that belong to a user_id
         :rtype: list [dict(), dict()]
         """
-        aggregate = dict()
-        counts = dict()
+        with self.metrics.timer("ownership"):
+            return self.__ownership(log_base)
+
+    def __ownership(self, log_base):
+        """ Sums and mean persistence per user (see calculate_ownership())
+
+        :param log_base: base for logarithm that helps curve the influence of older commits
+        :type log_base: int
+
+        :return: [sums, avg_persistence]
+        :rtype: list [dict(), dict()]
+        """
         sums_persistence = dict()
-        persistence = [self.commit_no + 1 - x for x in self.code]  # inverting scores to get persistence
         avg_persistence = dict()
-        i = 0  # auxiliary counter
-        for x in self.code:  # self.code and persistence are exactly the same length
-            if counts.get(x, 0) == 0:
-                counts[x] = 1
-            else:
-                counts[x] += 1
-            if aggregate.get(x, 0) == 0:
-                aggregate[x] = persistence[i]
-            else:
-                aggregate[x] += persistence[i]
-            i += 1
-        for x in counts:
-            if sums_persistence.get(self.user_index[x], 0) == 0:
-                sums_persistence[self.user_index[x]] = counts[x]
-                avg_persistence[self.user_index[x]] = aggregate[x]
-            else:
-                sums_persistence[self.user_index[x]] += counts[x]
-                avg_persistence[self.user_index[x]] += aggregate[x]
-        for x in avg_persistence:
-            avg_persistence[x] = round(math.log(avg_persistence[x] + 1, log_base), 2)
-        return [sums_persistence, avg_persistence]
+        # Character counts per commit are kept by the attribution store as code is inserted and carried over in
+        # update(). Every character of commit x has the same persistence (commit_no + 1 - x, the commits of origins all
+        # count as the last of them), so the persistence sum of a commit is its count shifted by the current commit
+        # number and this only costs O(commits with code left).
+        # Sums are accumulated per user id and keyed by user at the end.
+        for x, count in self.code.counts.items():
+            user_id = self.commit_users[x]
+            sums_persistence[user_id] = sums_persistence.get(user_id, 0) + count
+            persistence = self.commit_no + 1 - max(x, self.origin_commits)
+            avg_persistence[user_id] = avg_persistence.get(user_id, 0) + count * persistence
+        sums = dict()
+        avgs = dict()
+        for user_id in sums_persistence:
+            sums[self.users[user_id]] = sums_persistence[user_id]
+            avgs[self.users[user_id]] = round(math.log(avg_persistence[user_id] + 1, log_base), 2)
+        return [sums, avgs]
 
     @staticmethod
     def __total_random(n):
@@ -278,70 +873,82 @@ class GitPersistence:
             colors.append([random.randrange(0, 255), random.randrange(0, 255), random.randrange(0, 255)])
         return [(i[0], i[1], i[2]) for i in colors]
 
-    def html_print(self):
+    def __author_runs(self):
+        """ Merge runs of consecutive characters whose commits belong to the same user
+
+        :return: tuples of (user, run length)
+        :rtype: generator
         """
-        Lazy function for displaying in HTML the state of code after last update()
+        user_id = None
+        length = 0
+        for x, run_length in self.code.runs():
+            if self.commit_users[x] == user_id:
+                length += run_length
+            else:
+                if length > 0:
+                    yield self.users[user_id], length
+                user_id = self.commit_users[x]
+                length = run_length
+        if length > 0:
+            yield self.users[user_id], length
 
-        :return: html code
-        :rtype: str
+    def write_html(self, stream, chunk_size=65536):
         """
-        results = self.calculate_ownership()
-        # Creating styles for visual representation in HTML
-        spaced_colors = self.__total_random(len(set(self.user_index.values())))
-        html = """<html><head><style>
-        [tooltip]:before {
-        /* needed - do not touch */
-        content: attr(tooltip);
-        position: absolute;
-        opacity: 0;
-    
-        /* customizable */
-        transition: all 0.15s ease;
-        padding: 10px;
-        color: #333;
-        border-radius: 10px;
-        box-shadow: 2px 2px 1px silver;    
-        }
+        Write in HTML the state of code after last update() to a file-like object. Output is written incrementally, a
+        single span is emitted for consecutive characters of the same user and content is escaped.
 
-        [tooltip]:hover:before {
-        /* needed - do not touch */
-        opacity: 1;
-    
-        /* customizable */
-        background: yellow;
-        margin-top: -50px;
-        margin-left: 20px;    
-        }
+        :param stream: file-like object with a write() method receiving str
+        :type stream: io.TextIOBase
+        :param chunk_size: maximum number of characters of code written at once
+        :type chunk_size: int
 
-        [tooltip]:not([tooltip-persistent]):before {
-        pointer-events: none;
-        }
+        :return: None
+        :rtype: None
         """
-        i = 0  # auxiliary variable
+        results = self.calculate_ownership()
+        # Creating styles for visual representation in HTML
+        users = sorted(self.users)
+        spaced_colors = self.__total_random(len(users))
+        stream.write(self.html_header)
         hashed_codes = dict()
-        names_div = "<table>"
-        names_div += "<tr><td>Names</td><td>Characters Survived</td><td>Persistence</td></tr>"
-        for x in sorted(set(self.user_index.values())):
+        for i in range(0, len(users)):
             # first letter added to comply with CSS naming
-            hashed_codes[x] = "a%s" % (hashlib.md5(x.decode("utf-8").encode("utf-8")).hexdigest())
-            html += ".%s{background-color:rgb%s}" % (hashed_codes[x], str(spaced_colors[i]))
-            names_div += "<tr><td><span  class = '%s'>%s</span></td><td>%s</td><td>%s</td></tr>" % \
-                         (hashed_codes[x], x.decode("utf-8"), str(results[0].get(x, 0)), str(results[1].get(x, 0)))
-            i += 1
-        names_div += "</table>"
-        html += "</style></head><body><div style='float:left'>"
-        i = 0
-        for x in self.code:
-            if self.code_text[i] == "\n":
-                html += "<br />"
-            else:
-                html += "<span tooltip='%s' class = '%s'>%s</span>" % \
-                        (self.user_index[x].decode("utf-8"), hashed_codes[self.user_index[x]], self.code_text[i])
-            i += 1
-        html += "</div><div style='float:right'>"
-        html += names_div
-        html += "</div></body></html>"
-        return html
+            hashed_codes[users[i]] = "a%s" % (hashlib.md5(users[i].decode("utf-8").encode("utf-8")).hexdigest())
+            stream.write(".%s{background-color:rgb%s}" % (hashed_codes[users[i]], str(spaced_colors[i])))
+        stream.write("</style></head><body><div style='float:left'>")
+        position = 0
+        for user, length in self.__author_runs():
+            span = "<span tooltip='%s' class = '%s'>" % (escape(user.decode("utf-8")), hashed_codes[user])
+            stop = position + length
+            while position < stop:
+                text = self.code_text[position:min(position + chunk_size, stop)]
+                lines = text.split("\n")
+                for n in range(0, len(lines)):
+                    if n > 0:
+                        stream.write("<br />")
+                    if len(lines[n]) > 0:
+                        stream.write(span + escape(lines[n]) + "</span>")
+                position += len(text)
+        stream.write("</div><div style='float:right'>")
+        stream.write("<table>")
+        stream.write("<tr><td>Names</td><td>Characters Survived</td><td>Persistence</td></tr>")
+        for x in users:
+            stream.write("<tr><td><span  class = '%s'>%s</span></td><td>%s</td><td>%s</td></tr>" %
+                         (hashed_codes[x], escape(x.decode("utf-8")), str(results[0].get(x, 0)),
+                          str(results[1].get(x, 0))))
+        stream.write("</table>")
+        stream.write("</div></body></html>")
+
+    def html_print(self):
+        """
+        Lazy function for displaying in HTML the state of code after last update()
+
+        :return: html code
+        :rtype: str
+        """
+        output = io.StringIO()
+        self.write_html(output)
+        return output.getvalue()
 
 
 if __name__ == "__main__":
@@ -416,5 +1023,5 @@ if __name__ == "__main__":
     file1.update(rev2, "user2".encode("utf-8"))
     file1.update(rev3, "user3".encode("utf-8"))
     with open("diff.html", "w") as text_file:
-        text_file.write(file1.html_print())
+        file1.write_html(text_file)
     print(file1.calculate_ownership())
@@ -0,0 +1,193 @@
+import hashlib
+import struct
+import sys
+import threading
+from array import array
+
+
+class LineIndex:
+    """Repository-wide index of lines, to credit code moved to another file to its original authors
+    Lines are normalized (runs of white space collapsed) and hashed, lines that are too short to be told apart once
+    moved (braces, blank lines, ...) are left out. Every hash keeps its earliest occurrence: the time of the revision,
+    the file, the commit and the user credited with the line. Adding and looking up a line costs a dictionary operation,
+    so files can be matched against the whole repository as they are processed. Methods can be called from several
+    threads, e.g. when the index is served to worker processes by a multiprocessing manager.
+    """
+
+    min_length = 10  # characters of a normalized line, shorter lines are not indexed
+    digest_size = 8  # bytes of the hash of a line
+    shingle_length = 3  # indexed lines in a row from the same file for lookup_blocks() to return them
+    snapshot_magic = b"GPLI"
+    snapshot_version = 1
+
+    def __init__(self):
+        """ Initializes an empty index
+
+        :return: None
+        :rtype: None
+        """
+        self.entries = dict()  # line hash -> (time, file, commit, user)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """ Number of lines indexed
+
+        :return: number of line hashes
+        :rtype: int
+        """
+        return len(self.entries)
+
+    def __getstate__(self):
+        """ State of the index for pickle (e.g. returned by a manager), without its lock """
+        return {"entries": self.entries}
+
+    def __setstate__(self, state):
+        """ Restore the index from pickle """
+        self.entries = state["entries"]
+        self.lock = threading.Lock()
+
+    @classmethod
+    def hash_line(cls, line):
+        """ Hash of a normalized line
+
+        :param line: line of code
+        :type line: str
+
+        :return: hash of the line or None if the line is too short to be indexed
+        :rtype: bytes
+        """
+        normalized = " ".join(line.split())
+        if len(normalized) < cls.min_length:
+            return None
+        return hashlib.blake2b(normalized.encode("utf-8", "surrogatepass"), digest_size=cls.digest_size).digest()
+
+    def add(self, entries):
+        """ Add lines, an occurrence replaces the one kept for its hash only if it is earlier (ties are broken by file
+        and then by commit, so that the result does not depend on the order in which lines are added)
+
+        :param entries: tuples of (line hash, time, file, commit, user)
+        :type entries: collections.Iterable
+
+        :return: None
+        :rtype: None
+        """
+        with self.lock:
+            for key, time, file, commit, user in entries:
+                entry = self.entries.get(key)
+                if entry is None or (time, file, commit) < entry[:3]:
+                    self.entries[key] = (time, file, commit, user)
+
+    def lookup(self, keys, before, exclude=None):
+        """ Earliest occurrence of every line
+
+        :param keys: line hashes (None for lines that are not indexed)
+        :type keys: list
+        :param before: only occurrences from revisions older than this time are returned
+        :type before: int
+        :param exclude: file whose occurrences are not returned (e.g. the file being matched)
+        :type exclude: str
+
+        :return: (file, commit, user) of every line or None if the line has no such occurrence
+        :rtype: list
+        """
+        found = []
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key) if key is not None else None
+                if entry is None or entry[0] >= before or entry[1] == exclude:
+                    found.append(None)
+                else:
+                    found.append(entry[1:])
+        return found
+
+    def lookup_blocks(self, keys, before, exclude=None):
+        """ Earliest occurrence of the lines that belong to a block of at least shingle_length indexed lines in a row
+        found in the same file, lines that are common on their own (e.g. "return None") are only returned as part of
+        such a block. Lines that are not indexed (blank lines, braces, ...) are skipped and do not end a block.
+
+        :param keys: line hashes (None for lines that are not indexed)
+        :type keys: list
+        :param before: only occurrences from revisions older than this time are returned
+        :type before: int
+        :param exclude: file whose occurrences are not returned (e.g. the file being matched)
+        :type exclude: str
+
+        :return: (file, commit, user) of every line or None if the line is not in such a block
+        :rtype: list
+        """
+        found = self.lookup(keys, before, exclude)
+        block = []  # positions of the indexed lines of the current block
+        for k in range(0, len(keys) + 1):
+            if k < len(keys) and keys[k] is None:
+                continue
+            if k < len(keys) and found[k] is not None and len(block) > 0 and found[block[-1]][0] == found[k][0]:
+                block.append(k)
+                continue
+            if len(block) < self.shingle_length:
+                for j in block:
+                    found[j] = None
+            block = [k] if k < len(keys) and found[k] is not None else []
+        return found
+
+    def save(self, stream):
+        """ Write a binary snapshot of the index
+
+        :param stream: binary file-like object with a write() method
+        :type stream: io.BufferedIOBase
+
+        :return: None
+        :rtype: None
+        """
+        names = []  # files, commits and users, each stored once
+        name_ids = dict()
+        times = array('q')
+        ids = array('I')
+        with self.lock:
+            keys = list(self.entries)
+            for key in keys:
+                entry = self.entries[key]
+                times.append(entry[0])
+                for name in (entry[1].encode("utf-8", "surrogatepass"), entry[2].encode("utf-8"), entry[3]):
+                    if name not in name_ids:
+                        name_ids[name] = len(names)
+                        names.append(name)
+                    ids.append(name_ids[name])
+        if sys.byteorder == "big":
+            times.byteswap()
+            ids.byteswap()
+        stream.write(struct.pack("<4sHII", self.snapshot_magic, self.snapshot_version, len(names), len(keys)))
+        for name in names:
+            stream.write(struct.pack("<I", len(name)) + name)
+        stream.write(b"".join(keys))
+        stream.write(times.tobytes())
+        stream.write(ids.tobytes())
+
+    @classmethod
+    def load(cls, stream):
+        """ Restore an index from a snapshot written by save()
+
+        :param stream: binary file-like object with a read() method
+        :type stream: io.BufferedIOBase
+
+        :return: index with the same lines as the one saved
+        :rtype: LineIndex
+        """
+        magic, version, name_count, entry_count = struct.unpack("<4sHII", stream.read(14))
+        if magic != cls.snapshot_magic or version != cls.snapshot_version:
+            raise ValueError("Not a LineIndex snapshot of version %s (read %s version %s)"
+                             % (str(cls.snapshot_version), repr(magic), str(version)))
+        names = [stream.read(struct.unpack("<I", stream.read(4))[0]) for x in range(0, name_count)]
+        keys = stream.read(entry_count * cls.digest_size)
+        times = array('q')
+        ids = array('I')
+        times.frombytes(stream.read(entry_count * times.itemsize))
+        ids.frombytes(stream.read(3 * entry_count * ids.itemsize))
+        if sys.byteorder == "big":
+            times.byteswap()
+            ids.byteswap()
+        index = cls()
+        for x in range(0, entry_count):
+            index.entries[keys[x * cls.digest_size:(x + 1) * cls.digest_size]] = (
+                times[x], names[ids[3 * x]].decode("utf-8", "surrogatepass"), names[ids[3 * x + 1]].decode("utf-8"),
+                names[ids[3 * x + 2]])
+        return index
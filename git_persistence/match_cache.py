@@ -0,0 +1,114 @@
+import hashlib
+from collections import OrderedDict
+
+
+class MatchCache:
+    """Bounded LRU cache of line comparisons
+    Maps a pair of lines (old line, new line) to their similarity ratio and matching blocks, so that pairs compared
+    again in a later revision (reverts, lines edited back and forth, churn) are not compared from scratch. Pairs are
+    keyed by 128-bit digests of the lines, so that the cache does not keep the text of the lines alive (the chance that
+    two different lines have the same digest is negligible).
+    A cache is shared by every update() of a GitPersistence instance and can be shared by several instances (e.g. all
+    files processed by a worker process).
+    """
+
+    def __init__(self, size=10000):
+        """ Initializes an empty cache
+
+        :param size: maximum number of pairs kept, 0 disables the cache
+        :type size: int
+
+        :return: None
+        :rtype: None
+        """
+        self.size = size
+        self.entries = OrderedDict()  # digests of (old line, new line) -> (ratio, matching blocks)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """ Number of pairs kept
+
+        :return: number of pairs
+        :rtype: int
+        """
+        return len(self.entries)
+
+    @staticmethod
+    def __key(old_line, new_line):
+        """ Key of a pair of lines
+
+        :param old_line: line of the previous revision
+        :type old_line: str
+        :param new_line: line of the new revision
+        :type new_line: str
+
+        :return: 128-bit digests of both lines
+        :rtype: bytes
+        """
+        return (hashlib.blake2b(old_line.encode("utf-8", "surrogatepass"), digest_size=16).digest() +
+                hashlib.blake2b(new_line.encode("utf-8", "surrogatepass"), digest_size=16).digest())
+
+    def get(self, old_line, new_line):
+        """ Look up a pair of lines
+
+        :param old_line: line of the previous revision
+        :type old_line: str
+        :param new_line: line of the new revision
+        :type new_line: str
+
+        :return: (ratio, matching blocks) or None if the pair is not cached
+        :rtype: tuple
+        """
+        key = self.__key(old_line, new_line)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, old_line, new_line, ratio, blocks):
+        """ Add a pair of lines, evicting the least recently used pair if full
+
+        :param old_line: line of the previous revision
+        :type old_line: str
+        :param new_line: line of the new revision
+        :type new_line: str
+        :param ratio: similarity ratio of the lines
+        :type ratio: float
+        :param blocks: matching blocks of the lines (difflib.Match)
+        :type blocks: list
+
+        :return: None
+        :rtype: None
+        """
+        if self.size <= 0:
+            return
+        self.entries[self.__key(old_line, new_line)] = (ratio, blocks)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """ Hit and miss statistics
+
+        :return: hits, misses, evictions, hit rate and number of pairs kept
+        :rtype: dict
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "entries": len(self.entries)}
+
+    def clear(self):
+        """ Remove every pair, statistics are kept
+
+        :return: None
+        :rtype: None
+        """
+        self.entries.clear()
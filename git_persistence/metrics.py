@@ -0,0 +1,282 @@
+import json
+import time
+
+
+class _Timer:
+    """Context manager adding the time spent in its block to a timer of a Metrics object
+    """
+
+    def __init__(self, metrics, name):
+        """ Initializes the timer
+
+        :param metrics: metrics receiving the time
+        :type metrics: Metrics
+        :param name: name of the timer
+        :type name: str
+
+        :return: None
+        :rtype: None
+        """
+        self.metrics = metrics
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        """ Start timing """
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """ Stop timing, exceptions are propagated """
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Revision:
+    """Context manager collecting the counters and timers of its block in a per-revision record of a Metrics object
+    """
+
+    def __init__(self, metrics, labels):
+        """ Initializes the record
+
+        :param metrics: metrics holding the record
+        :type metrics: Metrics
+        :param labels: labels of the revision
+        :type labels: dict
+
+        :return: None
+        :rtype: None
+        """
+        self.metrics = metrics
+        self.record = {"labels": labels, "counters": dict(), "timers": dict()}
+
+    def __enter__(self):
+        """ Start the record """
+        self.metrics.revisions.append(self.record)
+        self.metrics.current = self.record
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """ Close the record, exceptions are propagated """
+        self.metrics.current = None
+        return False
+
+
+class Metrics:
+    """Counters and timers of the phases of GitPersistence and of the scripts using it
+    Phases are timed with timer() and events are counted with count(). Totals are kept for the whole object and, within
+    a revision() block, for that revision too. Metrics can be exported as JSON or in the Prometheus text format.
+    Pass an instance to GitPersistence(..., metrics=...) to enable them, the default NullMetrics costs nothing.
+
+    Phases timed by GitPersistence: line_split, anchor, exact_match, fuzzy_compare, best_match_selection,
+    attribution_rebuild and ownership. Counters: anchors, exact_matches, comparisons, pooled_comparisons,
+    match_cache_hits, fuzzy_matches, strategy_<strategy> (strategy used by an update, e.g. strategy_chunked) and
+    time_budget_exceeded. Phases timed by examples/run_git_persistence.py: git_io (reading blobs), git_fame and
+    line_index (lookup of moved code).
+    """
+
+    enabled = True
+
+    def __init__(self, **labels):
+        """ Initializes empty metrics
+
+        :param labels: labels of the metrics (e.g. file="setup.py")
+        :type labels: str
+
+        :return: None
+        :rtype: None
+        """
+        self.labels = labels
+        self.counters = dict()  # name -> value
+        self.timers = dict()  # name -> [seconds, calls]
+        self.revisions = []  # per-revision records: {"labels": dict, "counters": dict, "timers": dict}
+        self.current = None  # record of the revision() block being run
+
+    def count(self, name, value=1):
+        """ Increment a counter
+
+        :param name: name of the counter
+        :type name: str
+        :param value: increment
+        :type value: int
+
+        :return: None
+        :rtype: None
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+        if self.current is not None:
+            self.current["counters"][name] = self.current["counters"].get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        """ Add time to a timer
+
+        :param name: name of the timer
+        :type name: str
+        :param seconds: time spent
+        :type seconds: float
+
+        :return: None
+        :rtype: None
+        """
+        for timers in [self.timers] if self.current is None else [self.timers, self.current["timers"]]:
+            if name in timers:
+                timers[name][0] += seconds
+                timers[name][1] += 1
+            else:
+                timers[name] = [seconds, 1]
+
+    def timer(self, name):
+        """ Time a block: with metrics.timer("phase"): ...
+
+        :param name: name of the timer
+        :type name: str
+
+        :return: context manager
+        :rtype: _Timer
+        """
+        return _Timer(self, name)
+
+    def timed(self, name, iterable):
+        """ Time every step of an iteration (e.g. reading blobs lazily)
+
+        :param name: name of the timer
+        :type name: str
+        :param iterable: iterable to go through
+        :type iterable: collections.Iterable
+
+        :return: the items of the iterable
+        :rtype: generator
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def revision(self, **labels):
+        """ Collect the counters and timers of a block in a per-revision record: with metrics.revision(commit=...): ...
+
+        :param labels: labels of the revision
+        :type labels: str
+
+        :return: context manager
+        :rtype: _Revision
+        """
+        return _Revision(self, labels)
+
+    def merge(self, other):
+        """ Add the totals of other metrics (e.g. of another file) to these metrics
+
+        :param other: metrics to add
+        :type other: Metrics
+
+        :return: None
+        :rtype: None
+        """
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, (seconds, calls) in other.timers.items():
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += calls
+
+    def to_dict(self):
+        """ Metrics as plain data
+
+        :return: labels, counters, timers ({"seconds": ..., "calls": ...}) and per-revision records
+        :rtype: dict
+        """
+        def timers(values):
+            return dict((name, {"seconds": seconds, "calls": calls}) for name, (seconds, calls) in values.items())
+        return {"labels": self.labels,
+                "counters": self.counters,
+                "timers": timers(self.timers),
+                "revisions": [{"labels": record["labels"],
+                               "counters": record["counters"],
+                               "timers": timers(record["timers"])} for record in self.revisions]}
+
+    def to_json(self, **kwargs):
+        """ Metrics as JSON (see to_dict())
+
+        :param kwargs: arguments of json.dumps
+        :type kwargs: dict
+
+        :return: JSON document
+        :rtype: str
+        """
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix="git_persistence"):
+        """ Totals in the Prometheus text exposition format, counters as <prefix>_<name>_total and timers as
+        <prefix>_phase_seconds_total and <prefix>_phase_calls_total with a phase label
+
+        :param prefix: prefix of the metric names
+        :type prefix: str
+
+        :return: metrics, one sample per line
+        :rtype: str
+        """
+        def labels(values):
+            if len(values) == 0:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').
+                                                   replace("\n", "\\n")) for name, value in sorted(values.items()))
+        lines = []
+        for name in sorted(self.counters):
+            lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+            lines.append("%s_%s_total%s %s" % (prefix, name, labels(self.labels), str(self.counters[name])))
+        for metric, field in [("phase_seconds", 0), ("phase_calls", 1)]:
+            if len(self.timers) > 0:
+                lines.append("# TYPE %s_%s_total counter" % (prefix, metric))
+            for name in sorted(self.timers):
+                phase = dict(self.labels, phase=name)
+                lines.append("%s_%s_total%s %s" % (prefix, metric, labels(phase), repr(self.timers[name][field])))
+        return "\n".join(lines) + "\n"
+
+
+class _NullContext:
+    """Context manager that does nothing
+    """
+
+    def __enter__(self):
+        """ Does nothing """
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """ Does nothing, exceptions are propagated """
+        return False
+
+
+class NullMetrics:
+    """Metrics that are disabled: same interface as Metrics, nothing is recorded
+    """
+
+    enabled = False
+    __context = _NullContext()
+
+    def count(self, name, value=1):
+        """ Does nothing (see Metrics.count()) """
+        pass
+
+    def add_time(self, name, seconds):
+        """ Does nothing (see Metrics.add_time()) """
+        pass
+
+    def timer(self, name):
+        """ Context manager that does nothing (see Metrics.timer()) """
+        return self.__context
+
+    def timed(self, name, iterable):
+        """ The iterable itself (see Metrics.timed()) """
+        return iterable
+
+    def revision(self, **labels):
+        """ Context manager that does nothing (see Metrics.revision()) """
+        return self.__context
+
+
+# Shared default of every GitPersistence created without metrics
+NULL_METRICS = NullMetrics()
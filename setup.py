@@ -5,6 +5,7 @@ setup(
     version='1.0',
     packages=['git_persistence'],
     install_requires=['psutil'],
+    extras_require={'numpy': ['numpy']},
     url='https://github.com/git-persistence',
     license='MIT',
     author='Michail Tsikerdekis',